@@ -0,0 +1,269 @@
+import argparse as ap
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+import scipy.sparse
+
+import binaryResponse
+import common
+import evaluation
+import hiddenMarkovModel as hmm
+import unigramTraits as unigramTraitsModule
+
+def timeIt(f, repeat = 3):
+	# Report the best of several runs to damp scheduling noise
+	best = float("inf")
+	result = None
+	for _ in xrange(0, repeat):
+		start = time.time()
+		result = f()
+		best = min(best, time.time() - start)
+
+	return (best, result)
+
+def printThroughput(name, seconds, numTokens):
+	print("%s:\t%.3f s\t%.0f tokens/s" % (name, seconds, numTokens / max(seconds, 1e-9)))
+
+def printMismatches(expected, actual):
+	mismatches = len(filter(lambda (e, a): e.taggedWords != a.taggedWords, zip(expected, actual)))
+	print("mismatched sentences: %d" % mismatches)
+
+def loadTrainTest(labeledFilePath):
+	lFormat = common.LabeledFormat()
+	return evaluation.splitTrainTest(list(lFormat.deserialize(labeledFilePath)), 1/5.0)
+
+def countTokens(sentences):
+	return sum([ len(sentence.words) for sentence in sentences ])
+
+def viterbi(train, test):
+	corpusStats = hmm.CorpusStatistics(train)
+	sentences = [ common.Sentence(taggedSentence.toWordSeq()) for taggedSentence in test ]
+	numTokens = countTokens(sentences)
+
+	scalarTime, expected = timeIt(lambda: map(hmm.ScalarTagDecoder(corpusStats).decode, sentences))
+	vectorTime, actual = timeIt(lambda: map(hmm.TagDecoder(corpusStats).decode, sentences))
+	batchTime, batched = timeIt(lambda: hmm.TagDecoder(corpusStats).decodeBatch(sentences))
+	posteriorTime, _ = timeIt(lambda: hmm.TagDecoder(corpusStats).posteriorBatch(sentences))
+	nBestTime, _ = timeIt(lambda: hmm.TagDecoder(corpusStats).decodeNBestBatch(sentences, 10))
+
+	printThroughput("ScalarTagDecoder.decode", scalarTime, numTokens)
+	printThroughput("TagDecoder.decode", vectorTime, numTokens)
+	printThroughput("TagDecoder.decodeBatch", batchTime, numTokens)
+	printThroughput("TagDecoder.posteriorBatch", posteriorTime, numTokens)
+	printThroughput("TagDecoder.decodeNBestBatch (k = 10)", nBestTime, numTokens)
+	print("speedup: decode %.1fx, decodeBatch %.1fx" % (scalarTime / vectorTime, scalarTime / batchTime))
+
+	printMismatches(expected, actual)
+	printMismatches(expected, batched)
+
+def tokenAccuracy(expected, actual):
+	pairs = [ (e, a) for (x, y) in zip(expected, actual) for (e, a) in zip(x.toTagSeq(), y.toTagSeq()) ]
+	return len(filter(lambda (e, a): e == a, pairs)) / float(max(len(pairs), 1))
+
+def trigram(train, test):
+	sentences = [ common.Sentence(taggedSentence.toWordSeq()) for taggedSentence in test ]
+	numTokens = countTokens(sentences)
+
+	firstOrder = hmm.TagDecoder(hmm.CorpusStatistics(train))
+	trigramStats = hmm.TrigramStatistics(train)
+	secondOrder = hmm.TrigramTagDecoder(trigramStats)
+	print("deleted interpolation lambdas (trigram, bigram, unigram): %.3f %.3f %.3f" % trigramStats.lambdas)
+
+	for (name, decoder) in [ ("TagDecoder.decodeBatch", firstOrder), ("TrigramTagDecoder.decodeBatch", secondOrder) ]:
+		seconds, decoded = timeIt(lambda: decoder.decodeBatch(sentences))
+		printThroughput(name, seconds, numTokens)
+		print("token accuracy: %.4f" % tokenAccuracy(test, decoded))
+
+def beam(train, test):
+	sentences = [ common.Sentence(taggedSentence.toWordSeq()) for taggedSentence in test ]
+	numTokens = countTokens(sentences)
+
+	corpusStats = hmm.CorpusStatistics(train)
+	numTags = len(corpusStats.States)
+
+	exactTime, exact = timeIt(lambda: hmm.TagDecoder(corpusStats).decodeBatch(sentences))
+	printThroughput("exact (%d tags)" % numTags, exactTime, numTokens)
+	print("token accuracy: %.4f" % tokenAccuracy(test, exact))
+
+	for beamWidth in [ k for k in [ 1, 2, 4, 8, 16, 32 ] if k < numTags ]:
+		for beamThreshold in [ None, 10.0, 5.0 ]:
+			decoder = hmm.BeamTagDecoder(corpusStats, beamWidth = beamWidth, beamThreshold = beamThreshold)
+			seconds, decoded = timeIt(lambda: decoder.decodeBatch(sentences))
+			printThroughput("beam %d threshold %s" % (beamWidth, beamThreshold), seconds, numTokens)
+			print("token accuracy: %.4f\tagreement with exact: %.4f\tspeedup: %.1fx" % (
+				tokenAccuracy(test, decoded), tokenAccuracy(exact, decoded), exactTime / seconds
+			))
+
+def logistic(train, test):
+	# Each token is a one word document labeled with its tag, as the dict
+	# version of LogisticRegression expects.
+	trainWords = [ taggedWord.word.lower() for taggedSentence in train for taggedWord in taggedSentence.taggedWords ]
+	trainTags = [ taggedWord.tag.lower() for taggedSentence in train for taggedWord in taggedSentence.taggedWords ]
+	testWords = [ taggedWord.word.lower() for taggedSentence in test for taggedWord in taggedSentence.taggedWords ]
+	testTags = [ taggedWord.tag.lower() for taggedSentence in test for taggedWord in taggedSentence.taggedWords ]
+
+	vocabulary = { word : index for (index, word) in enumerate(sorted(set(trainWords))) }
+	def toMatrix(words):
+		columns = [ vocabulary.get(word, -1) for word in words ]
+		rows = [ i for (i, column) in enumerate(columns) if column >= 0 ]
+		return scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, [ columns[i] for i in rows ])), shape = (len(words), len(vocabulary)))
+
+	print("vocabulary: %d words, %d training tokens" % (len(vocabulary), len(trainWords)))
+
+	def fitDict():
+		model = binaryResponse.LogisticRegression()
+		model.fit(trainWords, trainTags, learnRate = 1e-5, maxItr = 10)
+		return model
+
+	def predictDict(model):
+		return [ max(p.items(), key = lambda (label, prob): prob)[0] for p in [ model.predict([ word ]) for word in testWords ] ]
+
+	fitTime, dictModel = timeIt(fitDict, repeat = 1)
+	predictTime, predicted = timeIt(lambda: predictDict(dictModel), repeat = 1)
+	print("dict LogisticRegression:\tfit %.3f s\tpredict %.3f s\taccuracy %.4f" % (
+		fitTime, predictTime, numpy.mean([ e == a for (e, a) in zip(testTags, predicted) ])))
+
+	fitTime, sparseModel = timeIt(lambda: binaryResponse.SparseLogisticRegression().fit(toMatrix(trainWords), trainTags), repeat = 1)
+	predictTime, predicted = timeIt(lambda: sparseModel.predict(toMatrix(testWords)))
+	print("SparseLogisticRegression:\tfit %.3f s (%d epochs)\tpredict %.3f s\taccuracy %.4f" % (
+		fitTime, len(sparseModel.losses), predictTime, numpy.mean([ e == a for (e, a) in zip(testTags, predicted) ])))
+
+def linearSatisfies(unigramTrait, candidates, word):
+	# The candidate scans that word-part traits used before they were indexed
+	for candidate in candidates:
+		if isinstance(unigramTrait, unigramTraitsModule.InfixUnigramTrait):
+			if candidate.lower() in word.lower():
+				return (True, candidate)
+		elif isinstance(unigramTrait, unigramTraitsModule.PrefixUnigramTrait):
+			if len(candidate) < len(word) and word.lower().startswith(candidate):
+				return (True, candidate)
+		elif len(candidate) < len(word) and word.lower().endswith(candidate):
+			return (True, candidate)
+
+	return (False, None)
+
+def wordPartTraits(train, test):
+	words = [ taggedWord.word for taggedSentence in train for taggedWord in taggedSentence.taggedWords ]
+	wordPartTypes = (unigramTraitsModule.InfixUnigramTrait, unigramTraitsModule.PrefixUnigramTrait, unigramTraitsModule.SuffixUnigramTrait)
+
+	for unigramTrait in unigramTraitsModule.unigramTraitList:
+		if not isinstance(unigramTrait, wordPartTypes):
+			continue
+
+		candidates = unigramTrait.getCandidates()
+		linearTime, expected = timeIt(lambda: [ linearSatisfies(unigramTrait, candidates, word) for word in words ])
+		indexTime, actual = timeIt(lambda: [ unigramTrait.satisfies(candidates, word) for word in words ])
+
+		print("%s (%d candidates):\tlinear %.3f s\tindexed %.3f s\tspeedup %.1fx\tmismatches %d" % (
+			unigramTrait.getName(), len(candidates), linearTime, indexTime, linearTime / indexTime,
+			len(filter(lambda (e, a): e != a, zip(expected, actual)))
+		))
+
+def lineByLineDeserialize(labeledFilePath):
+	# The line-at-a-time LabeledFormat reader that preceded readSentenceBlocks
+	taggedSentences = []
+	taggedWords = []
+	with open(labeledFilePath, 'rb') as f:
+		for line in f:
+			line = line.strip('\n')
+			if len(line) == 0:
+				if len(taggedWords) > 0:
+					taggedSentences.append(common.TaggedSentence(taggedWords))
+				taggedWords = []
+				continue
+
+			parts = line.split('\t')
+			taggedWords.append(common.TaggedWord(parts[1], parts[0]))
+
+	if len(taggedWords) > 0:
+		taggedSentences.append(common.TaggedSentence(taggedWords))
+
+	return taggedSentences
+
+def reader(labeledFilePath):
+	lFormat = common.LabeledFormat()
+	megabytes = os.path.getsize(labeledFilePath) / float(1 << 20)
+
+	# The text rows read a copy with no cache next to it so that they time
+	# the text parser. A fresh cache next to the input gets rows of its own.
+	textDirPath = tempfile.mkdtemp()
+	textFilePath = os.path.join(textDirPath, os.path.basename(labeledFilePath))
+	shutil.copyfile(labeledFilePath, textFilePath)
+
+	readers = [
+		("line by line", lambda: lineByLineDeserialize(textFilePath)),
+		("LabeledFormat.deserialize", lambda: list(lFormat.deserialize(textFilePath))),
+		("LabeledFormat.deserializeColumns", lambda: list(lFormat.deserializeColumns(textFilePath))),
+		("LabeledFormat.deserializeCorpus", lambda: lFormat.deserializeCorpus(textFilePath)),
+	]
+
+	useCache = common.CorpusCacheFormat().isFresh(labeledFilePath)
+	if useCache:
+		readers += [
+			("LabeledFormat.deserialize (cache)", lambda: list(lFormat.deserialize(labeledFilePath))),
+			("LabeledFormat.deserializeColumns (cache)", lambda: list(lFormat.deserializeColumns(labeledFilePath))),
+			("LabeledFormat.deserializeCorpus (cache)", lambda: lFormat.deserializeCorpus(labeledFilePath)),
+		]
+
+	try:
+		for (name, f) in readers:
+			seconds, _ = timeIt(f)
+			print("%s:\t%.3f s\t%.1f MB/s" % (name, seconds, megabytes / max(seconds, 1e-9)))
+
+		expected = lineByLineDeserialize(textFilePath)
+		printMismatches(expected, list(lFormat.deserialize(textFilePath)))
+		if useCache:
+			printMismatches(expected, list(lFormat.deserialize(labeledFilePath)))
+	finally:
+		shutil.rmtree(textDirPath)
+
+if __name__ == "__main__":
+	parser = ap.ArgumentParser(description="Throughput benchmarks")
+
+	subparsers = parser.add_subparsers(dest='name')
+
+	viterbiParser = subparsers.add_parser('viterbi')
+	viterbiParser.add_argument('labeledFilePath')
+
+	trigramParser = subparsers.add_parser('trigram')
+	trigramParser.add_argument('labeledFilePath')
+
+	beamParser = subparsers.add_parser('beam')
+	beamParser.add_argument('labeledFilePath')
+
+	logisticParser = subparsers.add_parser('logistic')
+	logisticParser.add_argument('labeledFilePath')
+
+	traitsParser = subparsers.add_parser('traits')
+	traitsParser.add_argument('labeledFilePath')
+
+	readerParser = subparsers.add_parser('reader')
+	readerParser.add_argument('labeledFilePath')
+
+	args = parser.parse_args()
+
+	if args.name == 'viterbi':
+		train, test = loadTrainTest(args.labeledFilePath)
+		viterbi(train, test)
+
+	elif args.name == 'trigram':
+		train, test = loadTrainTest(args.labeledFilePath)
+		trigram(train, test)
+
+	elif args.name == 'beam':
+		train, test = loadTrainTest(args.labeledFilePath)
+		beam(train, test)
+
+	elif args.name == 'logistic':
+		train, test = loadTrainTest(args.labeledFilePath)
+		logistic(train, test)
+
+	elif args.name == 'traits':
+		train, test = loadTrainTest(args.labeledFilePath)
+		wordPartTraits(train, test)
+
+	elif args.name == 'reader':
+		reader(args.labeledFilePath)
@@ -1,6 +1,10 @@
 import collections
 import math
 
+import numpy
+import scipy.sparse
+import scipy.special
+
 class LogisticRegression:
 	def __init__(self):
 		self.labels = []
@@ -59,3 +63,103 @@ class LogisticRegression:
 
 	def __getUnique(self, stringList):
 		return list(set(map(lambda x : x.lower(), filter(lambda x: not x is None, stringList))))
+
+class SparseLogisticRegression:
+	# Logistic regression over a document-term matrix (scipy.sparse or dense,
+	# one row per document) trained by mini-batch SGD, with AdaGrad step sizes
+	# and an L2 penalty.
+	# P(labels[1] | x) = 1 / (1 + exp(-(bias + weights . x))). A
+	# validationFraction of the rows is held out, and training stops once the
+	# held out log loss has not improved by tolerance for patience epochs.
+	def __init__(self, learnRate = 0.5, regFactor = 1e-5, batchSize = 256, maxEpochs = 50, tolerance = 1e-4, patience = 3, validationFraction = 0.1, seed = 0):
+		assert learnRate > 0
+		assert regFactor >= 0
+		assert 0 <= validationFraction < 1
+
+		self.learnRate = learnRate
+		self.regFactor = regFactor
+		self.batchSize = batchSize
+		self.maxEpochs = maxEpochs
+		self.tolerance = tolerance
+		self.patience = patience
+		self.validationFraction = validationFraction
+		self.seed = seed
+
+		self.labels = []
+		self.weights = None
+		self.bias = 0.0
+		self.losses = []
+
+	def fit(self, X, labelList):
+		X = scipy.sparse.csr_matrix(X)
+		assert X.shape[0] > 0
+		assert X.shape[0] == len(labelList)
+
+		self.labels = sorted(set(labelList))
+		assert len(self.labels) == 2
+		y = numpy.array([ label == self.labels[1] for label in labelList ], dtype = float)
+
+		rand = numpy.random.RandomState(self.seed)
+		order = rand.permutation(X.shape[0])
+		numValidation = int(len(order) * self.validationFraction)
+		(validation, train) = (order[:numValidation], order[numValidation:])
+
+		self.weights = numpy.zeros(X.shape[1])
+		self.bias = 0.0
+		self.losses = []
+
+		sumSquares = numpy.zeros(X.shape[1])
+		biasSumSquares = 0.0
+
+		best = (float("inf"), self.weights.copy(), self.bias)
+		sinceBest = 0
+		for epoch in xrange(0, self.maxEpochs):
+			# Shuffle once per epoch so that batches are cheap row slices
+			rand.shuffle(train)
+			(epochX, epochY) = (X[train], y[train])
+			for start in xrange(0, len(train), self.batchSize):
+				batchX = epochX[start:start + self.batchSize]
+				residual = self.__sigmoid(batchX) - epochY[start:start + self.batchSize]
+
+				# Gradient of the mean log loss plus the L2 penalty. AdaGrad
+				# scales each step by its coordinate's gradient history, so
+				# rare words in a sparse matrix still learn quickly.
+				gradient = batchX.T.dot(residual) / len(residual) + self.regFactor * self.weights
+				sumSquares += gradient ** 2
+				self.weights -= self.learnRate * gradient / (numpy.sqrt(sumSquares) + 1e-8)
+
+				biasSumSquares += residual.mean() ** 2
+				self.bias -= self.learnRate * residual.mean() / (math.sqrt(biasSumSquares) + 1e-8)
+
+			if numValidation == 0:
+				continue
+
+			loss = self.__logLoss(X[validation], y[validation])
+			self.losses.append(loss)
+			if loss < best[0] - self.tolerance:
+				best = (loss, self.weights.copy(), self.bias)
+				sinceBest = 0
+			else:
+				sinceBest += 1
+				if sinceBest >= self.patience:
+					break
+
+		if numValidation > 0:
+			(_, self.weights, self.bias) = best
+
+		return self
+
+	def predictProba(self, X):
+		# Rows of X by [ P(labels[0]), P(labels[1]) ]
+		p = self.__sigmoid(scipy.sparse.csr_matrix(X))
+		return numpy.column_stack([ 1 - p, p ])
+
+	def predict(self, X):
+		return [ self.labels[int(p > 0.5)] for p in self.__sigmoid(scipy.sparse.csr_matrix(X)) ]
+
+	def __sigmoid(self, X):
+		return scipy.special.expit(X.dot(self.weights) + self.bias)
+
+	def __logLoss(self, X, y):
+		p = numpy.clip(self.__sigmoid(X), 1e-12, 1 - 1e-12)
+		return -numpy.mean(y * numpy.log(p) + (1 - y) * numpy.log(1 - p))
@@ -1,4 +1,14 @@
-class TaggedWord:
+import array
+import collections
+import mmap
+import os
+import struct
+
+import numpy
+
+class TaggedWord(object):
+	__slots__ = ('word', 'tag')
+
 	def __init__(self, word, tag):
 		self.word = word.strip()
 		self.tag = tag
@@ -12,7 +22,9 @@ class TaggedWord:
 
 		return (self.word == other.word) and (self.tag == other.tag)
 
-class TaggedSentence:
+class TaggedSentence(object):
+    __slots__ = ('taggedWords',)
+
     def __init__(self, taggedWords = []):
         self.taggedWords = taggedWords
 
@@ -25,15 +37,300 @@ class TaggedSentence:
     def __repr__(self):
         return " ".join(map(str, self.taggedWords))
 
-class Sentence:
+class Sentence(object):
+    __slots__ = ('words',)
+
     def __init__(self, words):
         self.words = words
 
     def __repr__(self):
         return " ".join(self.words)
 
+class TaggedCorpus:
+    # Columnar storage for many tagged sentences. Each distinct word and tag is
+    # stored once, tokens are int32 word ids and uint8 tag ids, and sentence i
+    # spans tokens offsets[i]:offsets[i + 1]. Sentences are read through
+    # TaggedSentenceView and TaggedWordView, which are created on access.
+    def __init__(self, taggedSentences = [], columns = []):
+        # Built from TaggedSentences and/or (words, tags, sentenceLengths)
+        # chunks such as those from LabeledFormat.deserializeColumns.
+        wordIndex = {}
+        tagIndex = {}
+
+        wordIds = array.array('i')
+        tagIds = array.array('B')
+        offsets = [ 0 ]
+
+        def extend(words, tags, sentenceLengths):
+            wordIds.extend([ wordIndex.setdefault(word, len(wordIndex)) for word in words ])
+
+            ids = [ tagIndex.setdefault(tag, len(tagIndex)) for tag in tags ]
+            if len(tagIndex) > 256:
+                raise ValueError("TaggedCorpus supports at most 256 distinct tags.")
+            tagIds.extend(ids)
+
+            for n in sentenceLengths:
+                offsets.append(offsets[-1] + n)
+
+        for taggedSentence in taggedSentences:
+            extend(taggedSentence.toWordSeq(), taggedSentence.toTagSeq(), [ len(taggedSentence.taggedWords) ])
+
+        for (words, tags, sentenceLengths) in columns:
+            extend(words, tags, sentenceLengths)
+
+        self.vocabulary = sorted(wordIndex, key = wordIndex.get)
+        self.tagNames = sorted(tagIndex, key = tagIndex.get)
+        self.wordIds = numpy.frombuffer(wordIds, dtype = numpy.int32)
+        self.tagIds = numpy.frombuffer(tagIds, dtype = numpy.uint8)
+        self.offsets = numpy.array(offsets, dtype = numpy.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.__sliceSentences(*i.indices(len(self)))
+
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("TaggedCorpus index out of range")
+
+        return TaggedSentenceView(self, self.offsets[i], self.offsets[i + 1])
+
+    def __iter__(self):
+        for i in xrange(0, len(self)):
+            yield self[i]
+
+    def __sliceSentences(self, start, end, step):
+        # Corpus of sentences start:end. Word ids are remapped to a vocabulary
+        # of just the words the slice uses, so that shards sent to worker
+        # processes only pickle their own words.
+        if step != 1:
+            raise ValueError("TaggedCorpus slices must be contiguous.")
+        end = max(start, end)
+
+        used, wordIds = numpy.unique(self.wordIds[self.offsets[start]:self.offsets[end]], return_inverse = True)
+
+        sliced = TaggedCorpus()
+        sliced.vocabulary = [ self.vocabulary[wordId] for wordId in used.tolist() ]
+        sliced.tagNames = self.tagNames
+        sliced.wordIds = wordIds.astype(numpy.int32)
+        sliced.tagIds = self.tagIds[self.offsets[start]:self.offsets[end]]
+        sliced.offsets = self.offsets[start:end + 1] - self.offsets[start]
+
+        return sliced
+
+    def toColumns(self, sentencesPerChunk = 100000):
+        # Yields (words, tags, sentenceLengths) chunks in the same shape as
+        # LabeledFormat.deserializeColumns.
+        for i in xrange(0, len(self), sentencesPerChunk):
+            offsets = self.offsets[i:i + sentencesPerChunk + 1]
+            start, end = offsets[0], offsets[-1]
+
+            words = [ self.vocabulary[wordId] for wordId in self.wordIds[start:end].tolist() ]
+            tags = [ self.tagNames[tagId] for tagId in self.tagIds[start:end].tolist() ]
+            yield (words, tags, numpy.diff(offsets).tolist())
+
+    def mapWords(self, f):
+        # New corpus with every word replaced by f(word). f is called once per
+        # distinct word rather than once per token.
+        mapped = TaggedCorpus()
+
+        newWordIndex = {}
+        remap = numpy.array([ newWordIndex.setdefault(f(word), len(newWordIndex)) for word in self.vocabulary ], dtype = numpy.int32)
+
+        mapped.vocabulary = sorted(newWordIndex, key = newWordIndex.get)
+        mapped.tagNames = self.tagNames
+        mapped.wordIds = remap[self.wordIds]
+        mapped.tagIds = self.tagIds
+        mapped.offsets = self.offsets
+
+        return mapped
+
+class TaggedSentenceView(object):
+    __slots__ = ('corpus', 'start', 'end')
+
+    def __init__(self, corpus, start, end):
+        self.corpus = corpus
+        self.start = start
+        self.end = end
+
+    @property
+    def taggedWords(self):
+        return [ TaggedWordView(self.corpus, i) for i in xrange(self.start, self.end) ]
+
+    def toWordSeq(self):
+        vocabulary = self.corpus.vocabulary
+        return [ vocabulary[i] for i in self.corpus.wordIds[self.start:self.end] ]
+
+    def toTagSeq(self):
+        tagNames = self.corpus.tagNames
+        return [ tagNames[i] for i in self.corpus.tagIds[self.start:self.end] ]
+
+    def __repr__(self):
+        return " ".join(map(str, self.taggedWords))
+
+class TaggedWordView(object):
+    __slots__ = ('corpus', 'index')
+
+    def __init__(self, corpus, index):
+        self.corpus = corpus
+        self.index = index
+
+    @property
+    def word(self):
+        return self.corpus.vocabulary[self.corpus.wordIds[self.index]]
+
+    @property
+    def tag(self):
+        return self.corpus.tagNames[self.corpus.tagIds[self.index]]
+
+    def __repr__(self):
+        return "%s/%s" % (self.tag, self.word)
+
+    def __eq__(self, other):
+        if other is None:
+            return False
+
+        return (self.word == other.word) and (self.tag == other.tag)
+
+def imapInOrder(pool, f, iterable, maxPending):
+    # Unlike Pool.imap, which drains the whole input up front, this never has
+    # more than maxPending tasks in flight.
+    pending = collections.deque()
+    for x in iterable:
+        pending.append(pool.apply_async(f, (x,)))
+        if len(pending) >= maxPending:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def readSentenceBlocks(filePath, chunkSize = 1 << 24):
+    # Memory maps the file and yields chunks of roughly chunkSize bytes, each
+    # cut just after a blank line so that no sentence spans two chunks.
+    if os.path.getsize(filePath) == 0:
+        return
+
+    with open(filePath, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < len(data):
+                end = len(data)
+                if start + chunkSize < len(data):
+                    cut = data.rfind("\n\n", start, start + chunkSize)
+                    if cut == -1:
+                        # Sentence longer than a chunk
+                        cut = data.find("\n\n", start + chunkSize)
+                    if cut != -1:
+                        end = cut + 2
+
+                yield data[start:end]
+                start = end
+        finally:
+            data.close()
+
+def splitSentenceBlock(block):
+    # Lines of each sentence in a chunk from readSentenceBlocks
+    for lines in block.split("\n\n"):
+        lines = lines.split("\n")
+        if "" in lines:
+            # Runs of blank lines, or the end of the file
+            lines = [ line for line in lines if len(line) > 0 ]
+
+        if len(lines) > 0:
+            yield lines
+
+class CorpusCacheFormat:
+    # Binary copy of a TaggedCorpus kept next to a .labeled or .unlabeled file
+    # and read back with a single mmap. The header records the size and mtime
+    # of the text file the cache was built from and is itself a multiple of 8
+    # bytes. After it: vocabulary and tag names as newline separated strings,
+    # then int64 offsets, int32 word ids and uint8 tag ids, each padded to 8
+    # bytes. Unlabeled corpora have no tag names and no tag ids.
+    magic = "TCCACHE"
+    version = 2
+    header = struct.Struct("<8sIIQdQQQQQQ")
+
+    def getCachePath(self, textFilePath):
+        return textFilePath + ".cache"
+
+    def isFresh(self, textFilePath):
+        cachePath = self.getCachePath(textFilePath)
+        if not os.path.exists(cachePath):
+            return False
+
+        with open(cachePath, 'rb') as f:
+            data = f.read(self.header.size)
+        if len(data) < self.header.size:
+            return False
+
+        fields = self.header.unpack(data)
+        if fields[0].rstrip("\0") != self.magic or fields[1] != self.version:
+            return False
+
+        # Compared for equality so that a rewrite within the same mtime tick
+        # still shows up as a size change
+        return (fields[3], fields[4]) == (os.path.getsize(textFilePath), os.path.getmtime(textFilePath))
+
+    def serialize(self, corpus, filePath, textFilePath):
+        vocabulary = "\n".join(corpus.vocabulary)
+        tagNames = "\n".join(corpus.tagNames)
+
+        with open(filePath, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, 0,
+                os.path.getsize(textFilePath), os.path.getmtime(textFilePath),
+                len(corpus.vocabulary), len(vocabulary), len(corpus.tagNames), len(tagNames),
+                len(corpus.offsets), len(corpus.wordIds)))
+
+            for data in [ vocabulary, tagNames,
+                corpus.offsets.astype(numpy.int64).tostring(),
+                corpus.wordIds.astype(numpy.int32).tostring(),
+                corpus.tagIds.astype(numpy.uint8).tostring() ]:
+                f.write(data)
+                f.write("\0" * (-len(data) % 8))
+
+    def deserialize(self, filePath):
+        raw = numpy.memmap(filePath, dtype = numpy.uint8, mode = 'r')
+
+        (magic, version, _, _, _, numWords, vocabularySize, numTags, tagNamesSize, numOffsets, numTokens) = self.header.unpack(raw[:self.header.size].tostring())
+        if magic.rstrip("\0") != self.magic or version != self.version:
+            raise ValueError("%s is not a version %d corpus cache." % (filePath, self.version))
+
+        def take(position, size):
+            return (raw[position:position + size], position + size + (-size % 8))
+
+        vocabulary, position = take(self.header.size, vocabularySize)
+        tagNames, position = take(position, tagNamesSize)
+        offsets, position = take(position, numOffsets * 8)
+        wordIds, position = take(position, numTokens * 4)
+        tagIds, position = take(position, numTokens if numTags > 0 else 0)
+
+        corpus = TaggedCorpus()
+        corpus.vocabulary = vocabulary.tostring().split("\n") if numWords > 0 else []
+        corpus.tagNames = tagNames.tostring().split("\n") if numTags > 0 else []
+        corpus.offsets = offsets.view(numpy.int64)
+        corpus.wordIds = wordIds.view(numpy.int32)
+        corpus.tagIds = tagIds
+
+        return corpus
+
 class LabeledFormat:
     def deserialize(self, filePath):
+        # One sentence at a time so that streaming callers stay in constant
+        # memory; bulk readers should use deserializeColumns instead.
+        cacheFormat = CorpusCacheFormat()
+        if cacheFormat.isFresh(filePath):
+            # Small chunks keep memory bounded without a view per sentence
+            for (words, tags, sentenceLengths) in cacheFormat.deserialize(cacheFormat.getCachePath(filePath)).toColumns(1000):
+                start = 0
+                for length in sentenceLengths:
+                    yield TaggedSentence([ TaggedWord(word, tag) for (word, tag) in zip(words[start:start + length], tags[start:start + length]) ])
+                    start += length
+            return
+
         taggedSentence = TaggedSentence([])
         with open(filePath, 'rb') as f:
             for line in f:
@@ -43,12 +340,48 @@ class LabeledFormat:
                         yield taggedSentence
                     taggedSentence = TaggedSentence([])
                 else:
-                    parts = line.split('\t')                      
+                    parts = line.split('\t')
                     taggedSentence.taggedWords.append(TaggedWord(parts[1], parts[0]))
-            
+
             if len(taggedSentence.taggedWords) > 0:
                 yield taggedSentence
-                    
+
+    def deserializeColumns(self, filePath, chunkSize = 1 << 24):
+        # Yields (words, tags, sentenceLengths) per chunk of the file, where
+        # words and tags are flat lists over every token in the chunk.
+        cacheFormat = CorpusCacheFormat()
+        if cacheFormat.isFresh(filePath):
+            for columns in cacheFormat.deserialize(cacheFormat.getCachePath(filePath)).toColumns():
+                yield columns
+            return
+
+        for block in readSentenceBlocks(filePath, chunkSize):
+            words = []
+            tags = []
+            sentenceLengths = []
+            for lines in splitSentenceBlock(block):
+                parts = [ line.split('\t') for line in lines ]
+                tags.extend([ part[0] for part in parts ])
+                # Stripped as TaggedWord does
+                words.extend([ part[1].strip() for part in parts ])
+                sentenceLengths.append(len(lines))
+
+            yield (words, tags, sentenceLengths)
+
+    def deserializeCorpus(self, filePath):
+        cacheFormat = CorpusCacheFormat()
+        if cacheFormat.isFresh(filePath):
+            return cacheFormat.deserialize(cacheFormat.getCachePath(filePath))
+
+        return TaggedCorpus(columns = self.deserializeColumns(filePath))
+
+    def serializeCache(self, taggedSentences, filePath):
+        # Call after serialize, the cache records the size and mtime of the text file.
+        # Empty sentences are left out as deserialize skips them in the text.
+        cacheFormat = CorpusCacheFormat()
+        taggedSentences = [ taggedSentence for taggedSentence in taggedSentences if len(taggedSentence.taggedWords) > 0 ]
+        cacheFormat.serialize(TaggedCorpus(taggedSentences), cacheFormat.getCachePath(filePath), filePath)
+
     def getGenes(self, taggedSentence):
 	# Put this here instead of TaggedSentence since the tags for a gene are 
 	# specific to this format.
@@ -80,6 +413,16 @@ class LabeledFormat:
 
 class UnlabeledFormat:
     def deserialize(self, filePath):
+        # One sentence at a time, see LabeledFormat.deserialize
+        cacheFormat = CorpusCacheFormat()
+        if cacheFormat.isFresh(filePath):
+            for (words, _, sentenceLengths) in cacheFormat.deserialize(cacheFormat.getCachePath(filePath)).toColumns(1000):
+                start = 0
+                for length in sentenceLengths:
+                    yield Sentence(words[start:start + length])
+                    start += length
+            return
+
         sentence = Sentence([])
         with open(filePath, 'rb') as f:
             for line in f:
@@ -93,7 +436,25 @@ class UnlabeledFormat:
 
             if len(sentence.words) > 0:
                 yield sentence
-                
+
+    def deserializeColumns(self, filePath, chunkSize = 1 << 24):
+        # Yields (words, sentenceLengths) per chunk of the file, where words is
+        # a flat list over every token in the chunk.
+        cacheFormat = CorpusCacheFormat()
+        if cacheFormat.isFresh(filePath):
+            for (words, _, sentenceLengths) in cacheFormat.deserialize(cacheFormat.getCachePath(filePath)).toColumns():
+                yield (words, sentenceLengths)
+            return
+
+        for block in readSentenceBlocks(filePath, chunkSize):
+            words = []
+            sentenceLengths = []
+            for lines in splitSentenceBlock(block):
+                words.extend(lines)
+                sentenceLengths.append(len(lines))
+
+            yield (words, sentenceLengths)
+
     def serialize(self, sentences, filepath):
         with open(filepath, 'wb') as f:
             for sentence in sentences:
@@ -101,3 +462,16 @@ class UnlabeledFormat:
                     f.write(word)
                     f.write("\n")
                 f.write("\n")
+
+    def serializeCache(self, sentences, filePath):
+        # Call after serialize, see LabeledFormat.serializeCache
+        words = []
+        sentenceLengths = []
+        for sentence in sentences:
+            if len(sentence.words) == 0:
+                continue
+            words.extend(sentence.words)
+            sentenceLengths.append(len(sentence.words))
+
+        cacheFormat = CorpusCacheFormat()
+        cacheFormat.serialize(TaggedCorpus(columns = [ (words, [], sentenceLengths) ]), cacheFormat.getCachePath(filePath), filePath)
@@ -164,8 +164,7 @@ def mostCommonTrigrams(train, tags):
 def unigramTraitsByTag(train, tags):
 	unigramTraits = unigramTraitsModule.unigramTraitList
 	traitNames = [ unigramTrait.getName() for unigramTrait in unigramTraits ]
-	for unigramTrait in unigramTraits:
-		unigramTrait.selfSelect(train, tags)
+	unigramTraitsModule.selfSelectAll(unigramTraits, train, tags)
 
 	unigramTraitsByTag = { t : { f : 0 for f in traitNames } for t in tags }
 	for taggedSentence in train:
@@ -189,8 +188,7 @@ def unigramTraitsByTag(train, tags):
 def mostFrequentByUnigramTraitAndTag(train, tags):
 	unigramTraits = unigramTraitsModule.unigramTraitList
 	traitNames = [ unigramTrait.getName() for unigramTrait in unigramTraits ]
-	for unigramTrait in unigramTraits:
-		unigramTrait.selfSelect(train, tags)
+	unigramTraitsModule.selfSelectAll(unigramTraits, train, tags)
 
 	unigramTraitsByTag = { t : { f : collections.Counter() for f in traitNames } for t in tags }
 	for taggedSentence in train:
@@ -246,7 +244,7 @@ if __name__ == "__main__":
 
 	labeledFilePath = sys.argv[1]
 	lFormat = common.LabeledFormat()
-	train = list(lFormat.deserialize(labeledFilePath))
+	train = lFormat.deserializeCorpus(labeledFilePath)
 	tags = sorted(["I", "O"])
 
 	# Insights on tokens
@@ -1,47 +1,84 @@
 import common
 
+import itertools
+import multiprocessing
 import re
 
-class TagFormat:
-	def __init__(self):
-		self.punc = re.compile("^[^A-Za-z0-9]+$")
-		pass
+punc = re.compile("^[^A-Za-z0-9]+$")
+tagBySuffix = { 'TAG': 'O', 'GENE1': 'I', 'GENE2': 'I' }
 
-	def deserialize(self, filePath):
-		taggedSentences = []
+def readRecordBlocks(f, blockSize):
+	# Lists of value lines, blockSize bytes of key/value pairs at a time,
+	# ending at the first pair where both lines are blank.
+	while True:
+		lines = f.readlines(blockSize)
+		if len(lines) % 2 == 1:
+			lines.append(f.readline())
 
-		with open(filePath) as f:
-			while True:
-				key = f.readline().strip()
-				value = f.readline().strip()
-				if (key == '' and value == '') or (key is None and value is None):
-					break
+		values = []
+		for (key, value) in itertools.izip(lines[0::2], lines[1::2]):
+			value = value.strip()
+			if key.strip() == '' and value == '':
+				if len(values) > 0:
+					yield values
+				return
+			values.append(value)
 
-				taggedSentences.append(self.__rawToTagged(value))
+		if len(lines) == 0:
+			return
 
-		return taggedSentences
+		yield values
 
-	def __rawToTagged(self, sentence):
-		taggedWords = []
-
-		rawWords = sentence.split()
-		for rawWord in rawWords:
-			word = None
-			tag = None
-
-			if rawWord.endswith('_TAG'):
-				word = rawWord[:-4]
-				tag = 'O'					
-			elif rawWord.endswith('_GENE1') or rawWord.endswith('_GENE2'):
-				word = rawWord[:-6]
-				tag = 'I'
-			else:
-				assert False
+def parseRecordBlock(values):
+	# (words, tags, sentenceLengths) for the sentences in a block
+	words = []
+	tags = []
+	sentenceLengths = []
+	for value in values:
+		n = len(words)
+		for rawWord in value.split():
+			(word, _, suffix) = rawWord.rpartition('_')
+			assert suffix in tagBySuffix
 
 			# Discard punctuation
-			if re.match(self.punc, word.strip()):
+			word = word.strip()
+			if punc.match(word):
 				continue
 
-			taggedWords.append(common.TaggedWord(word.strip(), tag))
+			words.append(word)
+			tags.append(tagBySuffix[suffix])
+		sentenceLengths.append(len(words) - n)
+
+	return (words, tags, sentenceLengths)
+
+class TagFormat:
+	def __init__(self):
+		self.punc = punc
+		pass
+
+	def deserialize(self, filePath):
+		return list(self.iterDeserialize(filePath))
+
+	def iterDeserialize(self, filePath, workers = 1, blockSize = 1 << 22):
+		for (words, tags, sentenceLengths) in self.deserializeColumns(filePath, workers, blockSize):
+			i = 0
+			for n in sentenceLengths:
+				yield common.TaggedSentence([ common.TaggedWord(word, tag) for (word, tag) in zip(words[i:i + n], tags[i:i + n]) ])
+				i += n
+
+	def deserializeColumns(self, filePath, workers = 1, blockSize = 1 << 22):
+		# Yields (words, tags, sentenceLengths) per block of the file, in file
+		# order. With workers > 1 the blocks are parsed in a process pool.
+		with open(filePath) as f:
+			blocks = readRecordBlocks(f, blockSize)
+			if workers <= 1:
+				for block in blocks:
+					yield parseRecordBlock(block)
+				return
 
-		return common.TaggedSentence(taggedWords)
+			pool = multiprocessing.Pool(workers)
+			try:
+				for columns in common.imapInOrder(pool, parseRecordBlock, blocks, 2 * workers):
+					yield columns
+			finally:
+				pool.terminate()
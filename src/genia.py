@@ -1,5 +1,6 @@
 import re
 import xml.dom.minidom
+import xml.etree.cElementTree as etree
 
 import common
 
@@ -9,9 +10,46 @@ class XmlFormat:
 		pass
 
 	def deserialize(self, filePath):
+		return list(self.iterDeserialize(filePath))
+
+	def iterDeserialize(self, filePath):
+		# Yields each sentence as soon as its closing tag is parsed and then
+		# drops the parsed elements, so the whole DOM is never held at once.
+		depth = 0
+		root = None
+		for (event, elem) in etree.iterparse(filePath, events = ("start", "end")):
+			if event == "start":
+				if root is None:
+					root = elem
+				depth += 1
+				continue
+
+			depth -= 1
+			if elem.tag == "sentence":
+				yield self.__ElementSentenceToTaggedSentence(elem)
+				elem.clear()
+
+			if depth == 1:
+				root.clear()
+
+	def deserializeDom(self, filePath):
+		# The original reader, which parses the whole file with minidom first
 		tree = xml.dom.minidom.parse(filePath)
 		return [ self.__XmlSentenceToTaggedSentence(sentenceElem) for sentenceElem in tree.getElementsByTagName("sentence") ]
 
+	def __ElementSentenceToTaggedSentence(self, sentenceElem):
+		# Text, then each child element followed by its tail, matching the
+		# order of minidom's childNodes
+		taggedWords = self.__TextToTaggedWords(sentenceElem.text or "", "text")
+		for child in sentenceElem:
+			if child.tag == "cons":
+				taggedWords += self.__TextToTaggedWords(child.get("lex", ""), "gene")
+			else:
+				assert False
+			taggedWords += self.__TextToTaggedWords(child.tail or "", "text")
+
+		return common.TaggedSentence(taggedWords)
+
 	def __XmlSentenceToTaggedSentence(self, sentenceElem):
 		return common.TaggedSentence( [ taggedWord for child in sentenceElem.childNodes for taggedWord in self.__XmlSentenceChildToTaggedWords(child) ] )
 
@@ -28,6 +66,9 @@ class XmlFormat:
 			else:
 				assert False
 
+		return self.__TextToTaggedWords(text, textType)
+
+	def __TextToTaggedWords(self, text, textType):
 		taggedWords = []
 		tokens = self.puncAndSpace.split(text)
 		if textType == "text":
@@ -11,7 +11,9 @@ if __name__ == "__main__":
 	taggedSentences = inputFormat.deserialize(corpusFilePath)
 	labeledFormat = common.LabeledFormat()
 	labeledFormat.serialize(taggedSentences, labeledFilePath)
+	labeledFormat.serializeCache(taggedSentences, labeledFilePath)
 
 	sentences = [ common.Sentence(taggedSentence.toWordSeq()) for taggedSentence in taggedSentences ]
 	unlabeledFormat = common.UnlabeledFormat()
 	unlabeledFormat.serialize(sentences, unlabeledFilePath)	
+	unlabeledFormat.serializeCache(sentences, unlabeledFilePath)
@@ -1,5 +1,7 @@
 import collections
 import math
+import multiprocessing
+import os
 
 import numpy
 
@@ -13,6 +15,25 @@ class Histogram:
     def observe(self, listOfStrings):
         self.freq.update(listOfStrings)
 
+    def merge(self, other):
+        self.freq.update(other.freq)
+
+    def retract(self, other):
+        # Callers check canRetract first so that a failed retraction leaves
+        # every histogram unchanged.
+        for (element, count) in other.freq.items():
+            self.freq[element] -= count
+            if self.freq[element] == 0:
+                del self.freq[element]
+
+    def canRetract(self, other):
+        return all([ self.freq[element] >= count for (element, count) in other.freq.items() ])
+
+    def copy(self):
+        copied = Histogram()
+        copied.merge(self)
+        return copied
+
     def toDistribution(self):
         numElements = 0.0
         for word in self.freq:
@@ -23,11 +44,113 @@ class Histogram:
             dist[word] = self.freq[word] / numElements
 
         return dist
-    
-class CorpusStatistics:
+
+def derivedProperty(name):
+    # Attribute of CorpusStatistics that is recomputed from the raw counts on
+    # first access after they change. Assigning it overrides the computed value.
+    def get(self):
+        self.refresh()
+        return getattr(self, "_" + name)
+
+    def set(self, value):
+        self.refresh()
+        setattr(self, "_" + name, value)
+        self.logSpace = None
+
+    return property(get, set)
+
+class CorpusStatistics(object):
+    # Keeps raw counts so that batches can be added with update or merge and
+    # taken away with retract. Distributions are rebuilt lazily on next use.
+    initVec = derivedProperty("initVec")
+    stateTrans = derivedProperty("stateTrans")
+    wordGivenTag = derivedProperty("wordGivenTag")
+    States = derivedProperty("States")
+    Indices = derivedProperty("Indices")
+
     def __init__(self, taggedSentences, useSmoothing=True):
-        uniqueTag = set()
-        
+        self.useSmoothing = useSmoothing
+
+        (self.tagFreq, self.initVecFreq, self.transFreq, self.wordGivenTagFreq) = self.__count(taggedSentences)
+
+        self.stale = True
+        self.logSpace = None
+
+    def update(self, taggedSentences):
+        self.__add(self.__count(taggedSentences))
+
+    def merge(self, other):
+        # Adds the counts of another CorpusStatistics into this one
+        self.__add((other.tagFreq, other.initVecFreq, other.transFreq, other.wordGivenTagFreq))
+
+    def retract(self, taggedSentences):
+        # Removes a batch previously added, e.g. the held out fold in cross
+        # validation.
+        (tagFreq, initVecFreq, transFreq, wordGivenTagFreq) = self.__count(taggedSentences)
+
+        pairs = [ (self.tagFreq, tagFreq), (self.initVecFreq, initVecFreq) ]
+        for (freq, batchFreq) in [ (self.transFreq, transFreq), (self.wordGivenTagFreq, wordGivenTagFreq) ]:
+            pairs += [ (freq.get(tag, Histogram()), hist) for (tag, hist) in batchFreq.items() ]
+
+        if not all([ hist.canRetract(batchHist) for (hist, batchHist) in pairs ]):
+            raise ValueError("Cannot retract sentences that were not observed.")
+
+        for (hist, batchHist) in pairs:
+            hist.retract(batchHist)
+
+        for freq in [ self.transFreq, self.wordGivenTagFreq ]:
+            for tag in [ tag for (tag, hist) in freq.items() if len(hist.freq) == 0 ]:
+                del freq[tag]
+
+        self.__invalidate()
+
+    def refresh(self):
+        if not self.stale:
+            return
+
+        self.stale = False
+
+        uniqueTag = set(self.tagFreq.freq)
+
+        initVecFreq = self.initVecFreq.copy()
+        transFreq = { tag: hist.copy() for (tag, hist) in self.transFreq.items() }
+
+        if self.useSmoothing:
+            self.__laplaceSmooth(uniqueTag, transFreq, initVecFreq)
+            
+        self.initVec = initVecFreq.toDistribution()
+        self.stateTrans = { tag: hist.toDistribution() for tag, hist in transFreq.items() }
+        self.wordGivenTag = { tag: hist.toDistribution() for tag, hist in self.wordGivenTagFreq.items() }
+
+        n = 1
+        States = {}
+        for tag in self.initVec:
+            States[tag] = n
+            n += 1
+
+        self.States = States
+        self.Indices = { index : tag for tag, index in self.States.items() }
+
+    def __invalidate(self):
+        self.stale = True
+        self.logSpace = None
+
+    def __add(self, counts):
+        (tagFreq, initVecFreq, transFreq, wordGivenTagFreq) = counts
+
+        self.tagFreq.merge(tagFreq)
+        self.initVecFreq.merge(initVecFreq)
+        for (freq, batchFreq) in [ (self.transFreq, transFreq), (self.wordGivenTagFreq, wordGivenTagFreq) ]:
+            for (tag, hist) in batchFreq.items():
+                freq.setdefault(tag, Histogram()).merge(hist)
+
+        self.__invalidate()
+
+    def __count(self, taggedSentences):
+        if isinstance(taggedSentences, common.TaggedCorpus):
+            return self.__countCorpus(taggedSentences)
+
+        tagFreq = Histogram()
         initVecFreq = Histogram()
         transFreq = {}
         wordGivenTagFreq = {}
@@ -35,7 +158,7 @@ class CorpusStatistics:
         for taggedSentence in taggedSentences:
             tw = taggedSentence.taggedWords;
             
-            uniqueTag.update(taggedSentence.toTagSeq())
+            tagFreq.observe(taggedSentence.toTagSeq())
             
             initVecFreq.observe([ tw[0].tag ])
 
@@ -44,21 +167,77 @@ class CorpusStatistics:
             for (cWord, pWord) in zip(tw[1:], tw):
                 self.__observeTransition(transFreq, pWord.tag, cWord.tag)
                 self.__observeLikelihood(wordGivenTagFreq, cWord)
-                
-        if useSmoothing:
-            self.__laplaceSmooth(uniqueTag, transFreq, initVecFreq)
-            
-        self.initVec = initVecFreq.toDistribution()
-        self.stateTrans = { tag: hist.toDistribution() for tag, hist in transFreq.items() }
-        self.wordGivenTag = { tag: hist.toDistribution() for tag, hist in wordGivenTagFreq.items() }
 
-        n = 1
-        self.States = {}
-        for tag in self.initVec:
-            self.States[tag] = n
-            n += 1
+        return (tagFreq, initVecFreq, transFreq, wordGivenTagFreq)
 
-        self.Indices = { index : tag for tag, index in self.States.items() }
+    def toLogSpace(self):
+        # Computed on first use so that all decoders built from these
+        # statistics share a single copy of the log-space tables.
+        if self.logSpace is None:
+            self.logSpace = self.__buildLogSpace()
+
+        return self.logSpace
+
+    def __buildLogSpace(self):
+        # Keep the iteration order of States so that ties in argmax resolve the
+        # same way they do in ScalarTagDecoder.
+        tags = list(self.States)
+        N = len(tags)
+
+        logInitVec = numpy.array([ safeLog(self.initVec.get(tag, 0.0)) for tag in tags ]).reshape((N,))
+
+        logStateTrans = numpy.array([
+            [ safeLog(self.stateTrans.get(fromTag, {}).get(toTag, 0.0)) for toTag in tags ]
+            for fromTag in tags
+        ]).reshape((N, N))
+
+        # Words are numbered in sorted order
+        words = sorted(set([ word for tag in self.wordGivenTag for word in self.wordGivenTag[tag] ]))
+        vocabulary = { word : index for (index, word) in enumerate(words) }
+
+        logWordGivenTag = numpy.empty((len(words) + 1, N))
+        logWordGivenTag.fill(float("-inf"))
+        for (j, tag) in enumerate(tags):
+            for (word, prob) in self.wordGivenTag.get(tag, {}).items():
+                logWordGivenTag[vocabulary[word], j] = safeLog(prob)
+
+        return LogSpaceStatistics(tags, logInitVec, logStateTrans, words, logWordGivenTag)
+
+    def __countCorpus(self, corpus):
+        # Same counts as __count, taken from the id arrays of a TaggedCorpus
+        # without materializing any tokens. Empty sentences are skipped.
+        tagNames = corpus.tagNames
+        numTags = len(tagNames)
+
+        def toHistogram(counts, names):
+            hist = Histogram()
+            for i in numpy.flatnonzero(counts):
+                hist.freq[names[i]] = int(counts[i])
+            return hist
+
+        tagIds = corpus.tagIds.astype(numpy.int64)
+        starts = corpus.offsets[:-1][numpy.diff(corpus.offsets) > 0]
+
+        tagFreq = toHistogram(numpy.bincount(tagIds, minlength = numTags), tagNames)
+        initVecFreq = toHistogram(numpy.bincount(tagIds[starts], minlength = numTags), tagNames)
+
+        # Consecutive tokens in the same sentence
+        follows = numpy.ones(len(tagIds), dtype = bool)
+        follows[starts] = False
+        follows = follows[1:]
+        pairs = numpy.bincount(tagIds[:-1][follows] * numTags + tagIds[1:][follows], minlength = numTags * numTags).reshape((numTags, numTags))
+
+        transFreq = {}
+        for i in numpy.flatnonzero(pairs.sum(axis = 1)):
+            transFreq[tagNames[i]] = toHistogram(pairs[i], tagNames)
+
+        wordGivenTagFreq = {}
+        uniquePairs, counts = numpy.unique(tagIds * len(corpus.vocabulary) + corpus.wordIds, return_counts = True)
+        for (pair, count) in zip(uniquePairs.tolist(), counts.tolist()):
+            (tagId, wordId) = divmod(pair, len(corpus.vocabulary))
+            wordGivenTagFreq.setdefault(tagNames[tagId], Histogram()).freq[corpus.vocabulary[wordId]] = count
+
+        return (tagFreq, initVecFreq, transFreq, wordGivenTagFreq)
 
     def __laplaceSmooth(self,uniqueTag, transFreq, initVecFreq):
         initVecFreq.observe(uniqueTag)
@@ -82,7 +261,510 @@ class CorpusStatistics:
         
         transFreq[fromPos].observe([toPos]);
 
+def countShard(args):
+    (taggedSentences, useSmoothing) = args
+    return CorpusStatistics(taggedSentences, useSmoothing)
+
+def buildCorpusStatistics(shards, useSmoothing=True, workers=1):
+    # Counts each shard separately, in a process pool when workers > 1, and
+    # merges the counts. Smoothing and normalization happen once at the end.
+    tasks = ( (shard, useSmoothing) for shard in shards )
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            shardStats = list(common.imapInOrder(pool, countShard, tasks, 2 * workers))
+        finally:
+            pool.terminate()
+    else:
+        shardStats = map(countShard, tasks)
+
+    corpusStats = CorpusStatistics([], useSmoothing)
+    for stats in shardStats:
+        corpusStats.merge(stats)
+
+    return corpusStats
+
+def logSumExp(x, axis):
+    # log(sum(exp(x))) along axis without overflow; -inf where every term is -inf
+    m = x.max(axis = axis)
+    finite = numpy.where(numpy.isneginf(m), 0.0, m)
+    with numpy.errstate(divide = 'ignore'):
+        return numpy.log(numpy.exp(x - numpy.expand_dims(finite, axis)).sum(axis = axis)) + finite
+
+def safeLog(x):
+    if x < 0:
+        raise ValueError("x must be greater than 0.")
+
+    if x == 0:
+        return float("-inf")
+
+    return math.log(x)
+
+def backtrack(backpointer, viterbi):
+    # Best B x T paths from the T x B x N backpointers of a first-order
+    # Viterbi and the B x N scores of its last position.
+    T, B, N = backpointer.shape
+    rows = numpy.arange(B)
+
+    paths = numpy.zeros((B, T), dtype=int)
+    paths[:, T - 1] = viterbi.argmax(axis = 1)
+    for t in xrange(T - 1, 0, -1):
+        paths[:, t - 1] = backpointer[t, rows, paths[:, t]]
+
+    return paths
+
+class LogSpaceStatistics:
+    def __init__(self, tags, logInitVec, logStateTrans, words, logWordGivenTag):
+        self.tags = tags
+
+        # logInitVec[j] = log P(tags[j])
+        self.logInitVec = logInitVec
+
+        # logStateTrans[i, j] = log P(tags[j] | tags[i])
+        self.logStateTrans = logStateTrans
+
+        # logWordGivenTag[w, j] = log P(words[w] | tags[j]), -inf where the
+        # word was never seen with that tag. The extra last row is all -inf and
+        # stands in for out of vocabulary words.
+        self.words = words
+        self.vocabulary = { word : index for (index, word) in enumerate(words) }
+        self.logWordGivenTag = logWordGivenTag
+
+    def toLogSpace(self):
+        return self
+
+    def toWordIds(self, words):
+        # Out of vocabulary words map to len(vocabulary)
+        unknown = len(self.vocabulary)
+        return numpy.array([ self.vocabulary.get(word, unknown) for word in words ], dtype=int)
+
+class ModelFormat:
+    # A trained model is a directory holding the log-space tables as .npy files
+    # so that they can be memory mapped and shared between decode processes.
+    version = 1
+
+    def serialize(self, logSpace, acceptedByTrait, dirPath):
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+
+        for name in self.__arrayNames():
+            numpy.save(os.path.join(dirPath, name + ".npy"), getattr(logSpace, name))
+
+        with open(os.path.join(dirPath, "vocabulary.txt"), 'wb') as f:
+            for word in logSpace.words:
+                f.write(word)
+                f.write("\n")
+
+        with open(os.path.join(dirPath, "model.txt"), 'wb') as f:
+            f.write("version\t%d\n" % self.version)
+            f.write("\t".join([ "tags" ] + logSpace.tags) + "\n")
+            for (name, accepted) in sorted(acceptedByTrait.items()):
+                f.write("\t".join([ "trait", name ] + accepted) + "\n")
+
+    def deserialize(self, dirPath, mmapMode = 'r'):
+        tags = None
+        acceptedByTrait = {}
+        with open(os.path.join(dirPath, "model.txt"), 'rb') as f:
+            for line in f:
+                parts = line.strip('\n').split('\t')
+                if parts[0] == "version" and int(parts[1]) != self.version:
+                    raise ValueError("Unsupported model version %s." % parts[1])
+                elif parts[0] == "tags":
+                    tags = parts[1:]
+                elif parts[0] == "trait":
+                    acceptedByTrait[parts[1]] = parts[2:]
+
+        with open(os.path.join(dirPath, "vocabulary.txt"), 'rb') as f:
+            words = [ line.strip('\n') for line in f ]
+
+        arrays = [ numpy.load(os.path.join(dirPath, name + ".npy"), mmap_mode = mmapMode) for name in self.__arrayNames() ]
+
+        return (LogSpaceStatistics(tags, arrays[0], arrays[1], words, arrays[2]), acceptedByTrait)
+
+    def __arrayNames(self):
+        return [ "logInitVec", "logStateTrans", "logWordGivenTag" ]
+
 class TagDecoder:
+    def __init__(self, corpusStats, unknownWordProb = 1e-8):
+        self.unknownWordProb = unknownWordProb
+        self.corpusStats = corpusStats
+        self.logSpace = corpusStats.toLogSpace()
+
+        self.logUnknownWordProb = safeLog(unknownWordProb)
+
+    def decode(self, sentence):
+        return self.decodeBatch([ sentence ])[0]
+
+    def decodeBatch(self, sentences, batchSize = 1024):
+        sentences = list(sentences)
+        decoded = [ common.TaggedSentence([]) for sentence in sentences ]
+
+        tags = self.logSpace.tags
+        for (batch, wordIds) in self.__batches(sentences, batchSize):
+            paths = self.viterbi(wordIds)
+
+            for (i, path) in zip(batch, paths):
+                decoded[i] = common.TaggedSentence([
+                    common.TaggedWord(word, tags[j]) for (word, j) in zip(sentences[i].words, path)
+                ])
+
+        return decoded
+
+    def decodeNBest(self, sentence, k = 10):
+        return self.decodeNBestBatch([ sentence ], k)[0]
+
+    def decodeNBestBatch(self, sentences, k = 10, batchSize = 1024):
+        # Up to k (TaggedSentence, log probability) pairs per sentence, best
+        # first. Fewer are returned when fewer than k taggings are possible.
+        if k < 1:
+            raise ValueError("k must be at least 1.")
+
+        sentences = list(sentences)
+        decoded = [ [ (common.TaggedSentence([]), 0.0) ] for sentence in sentences ]
+
+        tags = self.logSpace.tags
+        for (batch, wordIds) in self.__batches(sentences, batchSize):
+            paths, scores = self.nBestViterbi(wordIds, k)
+
+            # Plain lists index tags much faster than numpy scalars
+            for (i, sentencePaths, sentenceScores) in zip(batch, paths.tolist(), scores.tolist()):
+                decoded[i] = [
+                    (common.TaggedSentence([ common.TaggedWord(word, tags[j]) for (word, j) in zip(sentences[i].words, path) ]), score)
+                    for (path, score) in zip(sentencePaths, sentenceScores) if score != float("-inf")
+                ]
+
+        return decoded
+
+    def nBestViterbi(self, wordIds, k):
+        # List Viterbi. wordIds is a B x T array of sentences of equal length,
+        # returns B x k x T tag indices and their B x k log probabilities,
+        # best first. Ties keep the order exact Viterbi would choose.
+        if k < 1:
+            raise ValueError("k must be at least 1.")
+
+        emissions = self.emissionScores(wordIds)
+        B, T, N = emissions.shape
+        rows = numpy.arange(B)[:, numpy.newaxis]
+
+        # viterbi[b, j, r] is the r-th best path of sentence b ending in tags[j]
+        viterbi = numpy.empty((B, N, k))
+        viterbi.fill(float("-inf"))
+        viterbi[:, :, 0] = self.logSpace.logInitVec + emissions[:, 0]
+
+        # backpointer[t, b, j, r] indexes the (previous tag, rank) flattened
+        # as tag * k + rank.
+        backpointer = numpy.zeros((T, B, N, k), dtype=int)
+
+        # recursion, scores[b, i * k + r, j] extends the r-th best path ending
+        # in tags[i] at t - 1 with tags[j] at t.
+        for t in xrange(1, T):
+            scores = viterbi[:, :, :, numpy.newaxis] + self.logSpace.logStateTrans[:, numpy.newaxis, :]
+            scores = scores.reshape((B, N * k, N))
+            best = numpy.argsort(-scores, axis = 1, kind = 'mergesort')[:, :k]
+            backpointer[t] = best.transpose((0, 2, 1))
+            viterbi = numpy.take_along_axis(scores, best, axis = 1).transpose((0, 2, 1)) + emissions[:, t, :, numpy.newaxis]
+
+        # termination
+        final = viterbi.reshape((B, N * k))
+        best = numpy.argsort(-final, axis = 1, kind = 'mergesort')[:, :k]
+        scores = final[rows, best]
+
+        paths = numpy.zeros((B, best.shape[1], T), dtype=int)
+        paths[:, :, T - 1] = best // k
+        rank = best % k
+        for t in xrange(T - 1, 0, -1):
+            previous = backpointer[t, rows, paths[:, :, t], rank]
+            paths[:, :, t - 1] = previous // k
+            rank = previous % k
+
+        return (paths, scores)
+
+    def posterior(self, sentence):
+        return self.posteriorBatch([ sentence ])[0]
+
+    def posteriorBatch(self, sentences, batchSize = 1024):
+        # (marginals, logLikelihood) per sentence, where marginals[t, j] is
+        # P(tag at t = tags[j] | sentence) and logLikelihood is
+        # log P(sentence).
+        sentences = list(sentences)
+        N = len(self.logSpace.tags)
+        posteriors = [ (numpy.zeros((0, N)), 0.0) for sentence in sentences ]
+
+        for (batch, wordIds) in self.__batches(sentences, batchSize):
+            marginals, logLikelihoods = self.forwardBackward(wordIds)
+            for (b, i) in enumerate(batch):
+                posteriors[i] = (marginals[b], logLikelihoods[b])
+
+        return posteriors
+
+    def __batches(self, sentences, batchSize):
+        # Bucket by length so that every sentence in a batch shares the same
+        # lattice shape and no padding is needed. Yields (indices into
+        # sentences, B x T word ids); empty sentences are skipped.
+        byLength = collections.defaultdict(list)
+        for (i, sentence) in enumerate(sentences):
+            byLength[len(sentence.words)].append(i)
+
+        for (T, indices) in byLength.items():
+            if T <= 0:
+                continue
+
+            for start in xrange(0, len(indices), batchSize):
+                batch = indices[start:start + batchSize]
+                yield (batch, numpy.array([ self.logSpace.toWordIds(sentences[i].words) for i in batch ]))
+
+    def emissionScores(self, wordIds):
+        # B x T x N log P(word | tag) for a B x T array of word ids.
+        # Anything unseen falls back to unknownWordProb. The shared (possibly
+        # memory mapped) table itself is never written to.
+        emissions = self.logSpace.logWordGivenTag[wordIds]
+        return numpy.where(numpy.isneginf(emissions), self.logUnknownWordProb, emissions)
+
+    def viterbi(self, wordIds):
+        # wordIds is a B x T array of sentences of equal length, returns a
+        # B x T array of tag indices.
+        emissions = self.emissionScores(wordIds)
+        B, T, N = emissions.shape
+
+        backpointer = numpy.zeros((T, B, N), dtype=int)
+
+        # Initialization
+        viterbi = self.logSpace.logInitVec + emissions[:, 0]
+
+        # recursion, scores[b, i, j] is the best path of sentence b ending in
+        # tags[i] at t - 1 followed by tags[j] at t.
+        for t in xrange(1, T):
+            scores = viterbi[:, :, numpy.newaxis] + self.logSpace.logStateTrans
+            backpointer[t] = scores.argmax(axis = 1)
+            viterbi = scores.max(axis = 1) + emissions[:, t]
+
+        # termination
+        return backtrack(backpointer, viterbi)
+
+    def forwardBackward(self, wordIds):
+        # wordIds is a B x T array of sentences of equal length, returns the
+        # B x T x N tag marginals and the B log-likelihoods. Everything stays
+        # in the log domain so long sentences do not underflow.
+        emissions = self.emissionScores(wordIds)
+        B, T, N = emissions.shape
+        logStateTrans = self.logSpace.logStateTrans
+
+        # alpha[t, b, j] = log P(words[:t + 1], tags[j] at t)
+        alpha = numpy.empty((T, B, N))
+        alpha[0] = self.logSpace.logInitVec + emissions[:, 0]
+        for t in xrange(1, T):
+            alpha[t] = logSumExp(alpha[t - 1][:, :, numpy.newaxis] + logStateTrans, axis = 1) + emissions[:, t]
+
+        # beta[t, b, i] = log P(words[t + 1:] | tags[i] at t)
+        beta = numpy.zeros((T, B, N))
+        for t in xrange(T - 2, -1, -1):
+            beta[t] = logSumExp(logStateTrans + (emissions[:, t + 1] + beta[t + 1])[:, numpy.newaxis, :], axis = 2)
+
+        logLikelihoods = logSumExp(alpha[T - 1], axis = 1)
+        marginals = numpy.exp(alpha + beta - logLikelihoods[:, numpy.newaxis])
+
+        return (marginals.transpose((1, 0, 2)), logLikelihoods)
+
+class BeamTagDecoder(TagDecoder):
+    # Approximate Viterbi that only extends the beamWidth best states at each
+    # position, and of those only the ones within beamThreshold (in log
+    # probability) of the best. Each step costs B x beamWidth x N rather than
+    # B x N x N. With beamWidth >= N and no threshold it matches TagDecoder.
+    def __init__(self, corpusStats, unknownWordProb = 1e-8, beamWidth = 4, beamThreshold = None):
+        if beamWidth < 1:
+            raise ValueError("beamWidth must be at least 1.")
+
+        TagDecoder.__init__(self, corpusStats, unknownWordProb)
+        self.beamWidth = beamWidth
+        self.beamThreshold = beamThreshold
+
+    def viterbi(self, wordIds):
+        emissions = self.emissionScores(wordIds)
+        B, T, N = emissions.shape
+        rows = numpy.arange(B)
+
+        backpointer = numpy.zeros((T, B, N), dtype=int)
+
+        # Initialization
+        viterbi = self.logSpace.logInitVec + emissions[:, 0]
+
+        # recursion, scores[b, i, j] is the best path of sentence b ending in
+        # tags[beam[b, i]] at t - 1 followed by tags[j] at t.
+        for t in xrange(1, T):
+            beam, beamScores = self.__prune(viterbi)
+            scores = beamScores[:, :, numpy.newaxis] + self.logSpace.logStateTrans[beam]
+            backpointer[t] = beam[rows[:, numpy.newaxis], scores.argmax(axis = 1)]
+            viterbi = scores.max(axis = 1) + emissions[:, t]
+
+        # termination
+        return backtrack(backpointer, viterbi)
+
+    def __prune(self, viterbi):
+        # B x k tag indices kept at this position and their scores
+        B, N = viterbi.shape
+        if self.beamWidth < N:
+            beam = numpy.argpartition(-viterbi, self.beamWidth - 1, axis = 1)[:, :self.beamWidth]
+        else:
+            beam = numpy.tile(numpy.arange(N), (B, 1))
+
+        beamScores = viterbi[numpy.arange(B)[:, numpy.newaxis], beam]
+        if not self.beamThreshold is None:
+            cutoff = beamScores.max(axis = 1)[:, numpy.newaxis] - self.beamThreshold
+            beamScores = numpy.where(beamScores < cutoff, float("-inf"), beamScores)
+
+        return (beam, beamScores)
+
+class TrigramStatistics:
+    # Second-order tag model. P(tag | two previous tags) interpolates trigram,
+    # bigram and unigram estimates with weights found by deleted interpolation
+    # (Brants, TnT, 2000). Emissions are those of a first-order
+    # CorpusStatistics over the same sentences.
+    def __init__(self, taggedSentences, useSmoothing=True):
+        if not isinstance(taggedSentences, common.TaggedCorpus):
+            taggedSentences = list(taggedSentences)
+
+        self.corpusStats = CorpusStatistics(taggedSentences, useSmoothing)
+        self.logSpace = self.__buildLogSpace()
+        self.tags = self.logSpace.tags
+
+        # Index len(tags) is the start of sentence padding
+        N = len(self.tags)
+        triFreq = self.__countTrigrams(taggedSentences)
+
+        self.lambdas = self.__deletedInterpolation(triFreq)
+        (l3, l2, l1) = self.lambdas
+
+        contextFreq = triFreq.sum(axis = 2)
+        biFreq = triFreq.sum(axis = 0)
+        uniFreq = biFreq.sum(axis = 0)
+
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            triProb = numpy.nan_to_num(triFreq / contextFreq[:, :, numpy.newaxis].astype(float))
+            biProb = numpy.nan_to_num(biFreq / biFreq.sum(axis = 1)[:, numpy.newaxis].astype(float))
+            uniProb = uniFreq / float(max(uniFreq.sum(), 1))
+
+            # logTrigramTrans[i, j, k] = log P(tags[k] | tags[i], tags[j])
+            self.logTrigramTrans = numpy.log(l3 * triProb + l2 * biProb[numpy.newaxis] + l1 * uniProb)
+
+    def toLogSpace(self):
+        return self.logSpace
+
+    def __buildLogSpace(self):
+        # The first-order tables widened to every tag in the corpus. Without
+        # smoothing States only holds the tags that start a sentence.
+        logSpace = self.corpusStats.toLogSpace()
+        missing = sorted(set(self.corpusStats.tagFreq.freq) - set(logSpace.tags))
+        if len(missing) == 0:
+            return logSpace
+
+        tags = logSpace.tags + missing
+        stateTrans = self.corpusStats.stateTrans
+        wordGivenTag = self.corpusStats.wordGivenTag
+
+        logInitVec = numpy.append(logSpace.logInitVec, [ float("-inf") ] * len(missing))
+        logStateTrans = numpy.array([
+            [ safeLog(stateTrans.get(fromTag, {}).get(toTag, 0.0)) for toTag in tags ]
+            for fromTag in tags
+        ])
+
+        logWordGivenTag = numpy.hstack([ logSpace.logWordGivenTag, numpy.full((len(logSpace.words) + 1, len(missing)), float("-inf")) ])
+        for (j, tag) in enumerate(missing, len(logSpace.tags)):
+            for (word, prob) in wordGivenTag.get(tag, {}).items():
+                logWordGivenTag[logSpace.vocabulary[word], j] = safeLog(prob)
+
+        return LogSpaceStatistics(tags, logInitVec, logStateTrans, logSpace.words, logWordGivenTag)
+
+    def __countTrigrams(self, taggedSentences):
+        # (N + 1) x (N + 1) x N counts of (tag two back, previous tag, tag)
+        N = len(self.tags)
+        tagIndex = { tag: index for (index, tag) in enumerate(self.tags) }
+
+        if isinstance(taggedSentences, common.TaggedCorpus):
+            # Every tag with a token is in tags, names mapped to N have none
+            remap = numpy.array([ tagIndex.get(tag, N) for tag in taggedSentences.tagNames ] + [ N ], dtype = numpy.int64)
+            tagIds = remap[taggedSentences.tagIds]
+            offsets = taggedSentences.offsets
+        else:
+            tagSeqs = [ taggedSentence.toTagSeq() for taggedSentence in taggedSentences ]
+            tagIds = numpy.array([ tagIndex[tag] for tagSeq in tagSeqs for tag in tagSeq ], dtype = numpy.int64)
+            offsets = numpy.cumsum([ 0 ] + [ len(tagSeq) for tagSeq in tagSeqs ])
+
+        position = numpy.arange(len(tagIds)) - numpy.repeat(offsets[:-1], numpy.diff(offsets))
+        previous = numpy.where(position >= 1, numpy.roll(tagIds, 1), N)
+        twoBack = numpy.where(position >= 2, numpy.roll(tagIds, 2), N)
+
+        triFreq = numpy.bincount((twoBack * (N + 1) + previous) * (N + 1) + tagIds, minlength = (N + 1) ** 3)
+        return triFreq.reshape((N + 1, N + 1, N + 1))[:, :, :N]
+
+    def __deletedInterpolation(self, triFreq):
+        # Each trigram votes, with its count, for whichever of the trigram,
+        # bigram and unigram estimates best predicts it once it is held out.
+        biFreq = triFreq.sum(axis = 0)
+        contextFreq = triFreq.sum(axis = 2)[:, :, numpy.newaxis]
+        previousFreq = biFreq.sum(axis = 1)[numpy.newaxis, :, numpy.newaxis]
+        uniFreq = biFreq.sum(axis = 0)
+
+        def heldOut(freq, totalFreq):
+            return numpy.where(totalFreq > 1, (freq - 1.0) / numpy.maximum(totalFreq - 1, 1), 0.0)
+
+        estimates = numpy.array(numpy.broadcast_arrays(
+            heldOut(triFreq, contextFreq),
+            heldOut(biFreq[numpy.newaxis], previousFreq),
+            heldOut(uniFreq, uniFreq.sum())
+        ))
+
+        observed = triFreq > 0
+        votes = numpy.bincount(estimates.argmax(axis = 0)[observed], weights = triFreq[observed], minlength = 3)
+        if votes.sum() == 0:
+            return (1 / 3.0, 1 / 3.0, 1 / 3.0)
+
+        return tuple(votes / votes.sum())
+
+class TrigramTagDecoder(TagDecoder):
+    # Viterbi over states that are pairs of (previous tag, tag)
+    def __init__(self, trigramStats, unknownWordProb = 1e-8):
+        TagDecoder.__init__(self, trigramStats, unknownWordProb)
+        self.logTrigramTrans = trigramStats.logTrigramTrans
+
+    def viterbi(self, wordIds):
+        emissions = self.emissionScores(wordIds)
+        B, T, N = emissions.shape
+        rows = numpy.arange(B)
+        start = self.logTrigramTrans[N]
+        logTrans = self.logTrigramTrans[:N, :N]
+
+        paths = numpy.zeros((B, T), dtype=int)
+
+        # Initialization
+        viterbi = start[N] + emissions[:, 0]
+        if T == 1:
+            paths[:, 0] = viterbi.argmax(axis = 1)
+            return paths
+
+        # viterbi[b, j, k] is the best path of sentence b ending in tags[j]
+        # then tags[k].
+        viterbi = viterbi[:, :, numpy.newaxis] + start[:N] + emissions[:, 1, numpy.newaxis, :]
+
+        # recursion, scores[b, i, j, k] extends the best path ending in tags[i]
+        # then tags[j] with tags[k].
+        backpointer = numpy.zeros((T, B, N, N), dtype=int)
+        for t in xrange(2, T):
+            scores = viterbi[:, :, :, numpy.newaxis] + logTrans
+            backpointer[t] = scores.argmax(axis = 1)
+            viterbi = scores.max(axis = 1) + emissions[:, t, numpy.newaxis, :]
+
+        # termination
+        best = viterbi.reshape((B, N * N)).argmax(axis = 1)
+        paths[:, T - 2] = best // N
+        paths[:, T - 1] = best % N
+        for t in xrange(T - 1, 1, -1):
+            paths[:, t - 2] = backpointer[t, rows, paths[:, t - 1], paths[:, t]]
+
+        return paths
+
+class ScalarTagDecoder:
+    # Reference implementation of Viterbi over the dictionaries held by
+    # CorpusStatistics. Kept for validating and benchmarking TagDecoder.
     def __init__(self, corpusStats, unknownWordProb = 1e-8):
         self.unknownWordProb = unknownWordProb
         self.corpusStats = corpusStats
@@ -97,7 +779,7 @@ class TagDecoder:
         viterbi = numpy.zeros((N + 2, T))
         viterbi.fill(float("-inf"))
         
-        backpointer = numpy.zeros((N + 2, T))
+        backpointer = numpy.zeros((N + 2, T), dtype=int)
 
         # Initialization
         for tag in self.corpusStats.States:
@@ -1,11 +1,15 @@
 from random import shuffle, sample, Random
 
 import argparse as ap
+import itertools
+import multiprocessing
 import numpy as np
+import os
 import sys
 import re
 import csv
 from sklearn.linear_model.logistic import LogisticRegression
+from sklearn.feature_extraction import FeatureHasher
 from sklearn.feature_extraction.text import CountVectorizer
 from numpy.core.defchararray import lower
 
@@ -15,17 +19,48 @@ import evaluation
 import unigramTraits as unigramTraitsModule
 
 class TagPredictor:
-    def __init__(self, training, featurizer):
-        self.vectorizer = CountVectorizer(ngram_range=(1, 3), analyzer=featurizer, binary=True)
+    # With hashed=True, features are hashed into numFeatures columns instead of
+    # being looked up in a vocabulary learned by CountVectorizer.
+    def __init__(self, training, featurizer, hashed = False, numFeatures = 2 ** 20):
+        if hashed:
+            self.vectorizer = FeatureHasher(numFeatures, input_type='string', alternate_sign=False)
+            self.featurizer = featurizer
+        else:
+            self.vectorizer = CountVectorizer(ngram_range=(1, 3), analyzer=featurizer, binary=True)
+            self.featurizer = None
+
         self.model = LogisticRegression(multi_class = 'ovr') # use one vs rest
 
-        self.model.fit(
-            self.vectorizer.fit_transform(self.__toSklearnX(training)), 
-            list(self.__toSklearnY(training))
-            )
+        X = list(self.__toSklearnX(training))
+        if self.featurizer is None:
+            X = self.vectorizer.fit_transform(X)
+        else:
+            X = self.__transform(X)
+
+        self.model.fit(X, list(self.__toSklearnY(training)))
 
     def predictValue(self, word):
-        return self.__indexToTag(self.model.predict(self.vectorizer.transform([word]))[0])
+        return self.predictValues([ word ])[0]
+
+    def predictValues(self, words):
+        # One sparse matrix and one model.predict call for all of words
+        if len(words) == 0:
+            return []
+
+        return [ self.__indexToTag(index) for index in self.model.predict(self.__transform(words)) ]
+
+    def predictSentences(self, sentences):
+        sentences = list(sentences)
+        tags = iter(self.predictValues([ word for sentence in sentences for word in sentence.words ]))
+
+        return [ common.TaggedSentence([ common.TaggedWord(word, next(tags)) for word in sentence.words ]) for sentence in sentences ]
+
+    def __transform(self, words):
+        if self.featurizer is None:
+            return self.vectorizer.transform(words)
+
+        # Binary features, as with CountVectorizer(binary=True)
+        return self.vectorizer.transform([ set(self.featurizer(word)) for word in words ])
     
     def __indexToTag(self, index):
         if(index == 0):
@@ -48,12 +83,21 @@ class TagPredictor:
                 yield self.__tagToIndex(taggedWord.tag)
 
 class Featurizer:
+    # featurizeSentence gives, for each token, these kinds of ids for the words
+    # at each offset in window. Id 0 stands for positions outside the sentence.
+    window = (-2, -1, 0, 1, 2)
+    kinds = ("trait", "word", "prefix", "suffix")
+    affixLength = 3
+
     def __init__(self, train):
 	self.unigramTraits = unigramTraitsModule.unigramTraitList
 
 	tags = ["I", "O"]
-	for unigramTrait in self.unigramTraits:
-		unigramTrait.selfSelect(train, tags)
+	unigramTraitsModule.selfSelectAll(self.unigramTraits, train, tags)
+
+	self.resolver = unigramTraitsModule.UnigramTraitResolver(self.unigramTraits)
+	self.idTables = [ {} for kind in self.kinds ]
+	self.wordFeatures = {}
 
     def __call__(self, word):
 	for unigramTrait in self.unigramTraits:
@@ -68,54 +112,46 @@ class Featurizer:
         except ValueError:
             return False
 
-    def featurize(self, previousWord, currentWord, nextWord):
-        return currentWord
-            
-    def featurizeSentence(self, sentence):
-        output = common.Sentence([])
-        
-        previousWord = None
+    def wordFeatureIds(self, word):
+        # Ids of each of kinds for a word, computed once per distinct word
+        if word in self.wordFeatures:
+            return self.wordFeatures[word]
+
+        lowerWord = word.lower()
+        values = (self.resolver.rewriteWord(word, "XXX"), word, lowerWord[:self.affixLength], lowerWord[-self.affixLength:])
+        ids = tuple([ idTable.setdefault(value, len(idTable) + 1) for (idTable, value) in zip(self.idTables, values) ])
 
-        for i, currentWord in zip(xrange(len(sentence.words)), sentence.words):
-            nextWord = None
-            if (i+1 < len(sentence.words)):
-                nextWord = sentence.words[i+1]
+        self.wordFeatures[word] = ids
+        return ids
             
-            output.append( self.featurize(previousWord, currentWord, nextWord) )
+    def featurizeSentence(self, sentence):
+        # T x (len(window) * len(kinds)) int array. Row t holds the ids of the
+        # words at t + offset for each offset in window, kinds varying fastest.
+        T = len(sentence.words)
+        radius = max([ abs(offset) for offset in self.window ])
 
-            previousWord = currentWord
+        padded = np.zeros((T + 2 * radius, len(self.kinds)), dtype=np.int32)
+        if T > 0:
+            padded[radius:radius + T] = [ self.wordFeatureIds(word) for word in sentence.words ]
 
-        return output
+        return np.hstack([ padded[radius + offset:radius + offset + T] for offset in self.window ])
 
     def featurizeSentences(self, sentences):
         for sentence in sentences:
             yield self.featurizeSentence(sentence)
 
     def featurizeTaggedSentence(self, taggedSentence):
-        output = common.TaggedSentence()
-        output.taggedWords = [];
-        
-        previousWord = None
-        
-        for i, taggedWord in zip(xrange(len(taggedSentence.taggedWords)), taggedSentence.taggedWords):
-            currentWord = taggedWord.word
-
-            nextWord = None
-            if (i + 1 < len(taggedSentence.taggedWords)):
-                nextWord = taggedSentence.taggedWords[i + 1].word
-            
-            output.taggedWords.append( common.TaggedWord(self.featurize(previousWord, currentWord, nextWord), taggedWord.tag)  )
-
-            previousWord = currentWord
-            
-        return output
+        return (self.featurizeSentence(common.Sentence(taggedSentence.toWordSeq())), taggedSentence.toTagSeq())
 
     def featurizeTaggedSentences(self, taggedSentences):
         for taggedSentence in taggedSentences:
             yield self.featurizeTaggedSentence(taggedSentence)
 
-def createDecoder(train):
-    return hmm.TagDecoder(hmm.CorpusStatistics(train), 1e-8)
+def createDecoder(corpusStats):
+    if isinstance(corpusStats, hmm.TrigramStatistics):
+        return hmm.TrigramTagDecoder(corpusStats, 1e-8)
+
+    return hmm.TagDecoder(corpusStats, 1e-8)
 
 def createTrainTest(inputFilePath, trainFilePath, testFilePath):
     fileformat = common.LabeledFormat()
@@ -130,53 +166,50 @@ def removeTags(inputFilePath, outputFilePath):
     
     outputFormat.serialize(map(lambda taggedSentence: common.Sentence(taggedSentence.toWordSeq()), inputFormat.deserialize(inputFilePath)), outputFilePath)
 
-def decode(trainFilePath, testFilePath, outputFilePath):   
+def trainModel(trainFilePath, workers = 1, order = 1):
 	# Load the training data
 	trainFormat = common.LabeledFormat()
-	train = list(trainFormat.deserialize(trainFilePath))
+	train = trainFormat.deserializeCorpus(trainFilePath)
 
 	unigramTraits = unigramTraitsModule.unigramTraitList
 
 	tags = ["I", "O"]
-	for unigramTrait in unigramTraits:
-		unigramTrait.selfSelect(train, tags)
-
-	for taggedSentence in train:
-		for taggedWord in taggedSentence.taggedWords:
-			matchApplied = False
-			for unigramTrait in unigramTraits:
-				hasMatch, match = unigramTrait.isAMatch(taggedWord.word)
-				if hasMatch:
-					newWord = unigramTrait.rewriteWord(match)
-					taggedWord.word = newWord
-					matchApplied = True
-					break
-
-			if not matchApplied:
-				taggedWord.word = "XXX"
-
-	# Create a decoder that operates over (B I O) values AND tags
+	unigramTraitsModule.selfSelectAll(unigramTraits, train, tags)
+
+	resolver = unigramTraitsModule.UnigramTraitResolver(unigramTraits)
+	train = train.mapWords(lambda word: resolver.rewriteWord(word, "XXX"))
+
+	# Create statistics that operate over (B I O) values AND tags
 	#A = [common.TaggedSentence( [ common.TaggedWord(w.tag, w.tag) for w in t.taggedWords] ) for t in train]
-	decoder = createDecoder(train)
+	if order == 2:
+		return hmm.TrigramStatistics(train)
 
-	# Load up the test data
-	testFormat = common.UnlabeledFormat()
-	test = list(testFormat.deserialize(testFilePath))
+	if workers <= 1:
+		return hmm.CorpusStatistics(train)
+
+	# A few shards per worker so the pool stays busy
+	shardSize = max(1, len(train) // (4 * workers) + 1)
+	shards = [ train[i:i + shardSize] for i in xrange(0, len(train), shardSize) ]
+	return hmm.buildCorpusStatistics(shards, workers = workers)
+
+def saveModel(trainFilePath, modelFilePath, workers = 1):
+	corpusStats = trainModel(trainFilePath, workers)
+	acceptedByTrait = unigramTraitsModule.getAcceptedByTrait(unigramTraitsModule.unigramTraitList)
+
+	hmm.ModelFormat().serialize(corpusStats.toLogSpace(), acceptedByTrait, modelFilePath)
 
-	B = []
-	for sentence in test:
-		b = []
-		for i, word in enumerate(sentence.words):
-			newWord = word
-			for unigramTrait in unigramTraits:
-				hasMatch, match = unigramTrait.isAMatch(word)
-				if hasMatch:
-					newWord = unigramTrait.rewriteWord(match)
-					break
+def loadModel(modelFilePath):
+	# The saved trait state keeps selfSelect from running again
+	logSpace, acceptedByTrait = hmm.ModelFormat().deserialize(modelFilePath)
+	unigramTraitsModule.setAcceptedByTrait(unigramTraitsModule.unigramTraitList, acceptedByTrait)
 
-			b.append(newWord)
+	return logSpace
 
-		B.append(common.Sentence(b))
+def rewriteSentence(sentence, resolver):
+	return common.Sentence([ resolver.rewriteWord(word, word) for word in sentence.words ])
+
+def decodeSentences(decoder, resolver, test):
+	B = [ rewriteSentence(sentence, resolver) for sentence in test ]
 
 	# For each word in a test sentence, predict its tag
 	#featurizer = Featurizer(train)
@@ -184,14 +217,74 @@ def decode(trainFilePath, testFilePath, outputFilePath):
 	#B = [ common.Sentence( [ classifier.predictValue(w) for w in s.words] ) for s in test]
 
 	## Decode the sentences, and then reassign the actual words to the results
-	D = map(lambda x: decoder.decode(x), B)
+	D = decoder.decodeBatch(B)
 	for (d, t) in zip(D, test):
 		for i in xrange(0, len(t.words)):
 			d.taggedWords[i].word = t.words[i]
 
-	# Save to disk
-	outputFormat = trainFormat
-	outputFormat.serialize(D, outputFilePath)
+	return D
+
+# Decoder and trait resolver of a decode worker process, see initDecodeWorker
+workerDecoder = None
+workerResolver = None
+
+def initDecodeWorker(decoder, resolver):
+	# Workers are forked, so the decoder (and the selected trait state) is
+	# shared copy-on-write with the parent rather than pickled.
+	global workerDecoder, workerResolver
+	workerDecoder = decoder
+	workerResolver = resolver
+
+def decodeShard(shard):
+	return decodeSentences(workerDecoder, workerResolver, shard)
+
+def toShards(sentences, shardSize):
+	sentences = iter(sentences)
+	while True:
+		shard = list(itertools.islice(sentences, shardSize))
+		if len(shard) == 0:
+			return
+		yield shard
+
+def decodeStream(decoder, resolver, sentences, shardSize):
+	# Only one shard is held in memory at a time
+	for shard in toShards(sentences, shardSize):
+		for d in decodeSentences(decoder, resolver, shard):
+			yield d
+
+def decode(trainFilePath, testFilePath, outputFilePath, workers = 1, shardSize = 1000, order = 1):
+	# trainFilePath is either labeled training data or a model saved by 'train'
+	if os.path.isdir(trainFilePath):
+		if order != 1:
+			raise ValueError("Models saved by 'train' are first order.")
+		corpusStats = loadModel(trainFilePath)
+	else:
+		corpusStats = trainModel(trainFilePath, workers, order)
+
+	decoder = createDecoder(corpusStats)
+	resolver = unigramTraitsModule.UnigramTraitResolver(unigramTraitsModule.unigramTraitList)
+
+	# Sentences flow from the test file through rewriting and decoding to the
+	# output file shardSize at a time, so memory does not grow with the corpus.
+	testFormat = common.UnlabeledFormat()
+	test = testFormat.deserialize(testFilePath)
+
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers, initDecodeWorker, (decoder, resolver))
+		shards = common.imapInOrder(pool, decodeShard, toShards(test, shardSize), 2 * workers)
+		D = itertools.chain.from_iterable(shards)
+	else:
+		D = decodeStream(decoder, resolver, test, shardSize)
+
+	# Save to disk. The pool is torn down even if decoding or writing fails
+	# part way through.
+	outputFormat = common.LabeledFormat()
+	try:
+		outputFormat.serialize(D, outputFilePath)
+	finally:
+		if not pool is None:
+			pool.terminate()
 
 	return decoder.corpusStats
 
@@ -290,10 +383,18 @@ if __name__ == '__main__':
     stripParser.add_argument('inputFilePath')
     stripParser.add_argument('outputFilePath')
  
+    trainParser = subparsers.add_parser('train')
+    trainParser.add_argument('trainFilePath')
+    trainParser.add_argument('modelFilePath')
+    trainParser.add_argument('--workers', type=int, default=1, help="number of counting processes")
+ 
     decodeParser = subparsers.add_parser('decode')
-    decodeParser.add_argument('trainFilePath')
+    decodeParser.add_argument('trainFilePath', help="labeled training data or a model directory written by 'train'")
     decodeParser.add_argument('testFilePath')
     decodeParser.add_argument('outFilePath')
+    decodeParser.add_argument('--workers', type=int, default=1, help="number of training and decode processes")
+    decodeParser.add_argument('--shard-size', dest='shardSize', type=int, default=1000, help="sentences held in memory per worker")
+    decodeParser.add_argument('--order', type=int, choices=[1, 2], default=1, help="1 for a bigram HMM, 2 for a trigram HMM")
  
     evalParser = subparsers.add_parser('eval')
     evalParser.add_argument('testFilePath')
@@ -314,8 +415,11 @@ if __name__ == '__main__':
     elif args.name == 'strip':
         removeTags(args.inputFilePath, args.outputFilePath)
  
+    elif args.name == 'train':
+        saveModel(args.trainFilePath, args.modelFilePath, args.workers)
+ 
     elif args.name == 'decode':
-        decode(args.trainFilePath, args.testFilePath, args.outFilePath)
+        decode(args.trainFilePath, args.testFilePath, args.outFilePath, args.workers, args.shardSize, args.order)
  
     elif args.name == 'eval':
         evaluate(args.testFilePath, args.decodeFilePath)
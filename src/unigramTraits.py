@@ -1,6 +1,11 @@
+import collections
 import operator
 import re
+import string
 
+import numpy
+
+import common
 import jointFreqMatrix
 
 class UnigramTrait:
@@ -16,6 +21,9 @@ class UnigramTrait:
 	def selfSelect(self, taggedSentences, tag):
 		pass
 
+	def selfSelectFromCounts(self, tagCountsByWord, tags):
+		pass
+
 class RegExUnigramTrait(UnigramTrait):
 	def isAMatch(self, word):
 		if word is None:
@@ -147,30 +155,139 @@ class RomanNumUnigramTrait(RegExUnigramTrait):
 	def getRegEx(self):
 		return self.regex
 
+class CandidateTrie:
+	# Trie over candidate strings, each terminal node remembers the earliest
+	# position of its candidate so that lookups keep first-match order.
+	def __init__(self, candidates):
+		self.root = {}
+		for (i, candidate) in enumerate(candidates):
+			node = self.root
+			for c in candidate:
+				node = node.setdefault(c, {})
+
+			if not None in node:
+				node[None] = i
+
+	def firstMatch(self, text, maxLength):
+		# Position of the earliest candidate that is a prefix of text and no
+		# longer than maxLength, or None.
+		best = None
+		node = self.root
+		for depth in xrange(0, maxLength + 1):
+			if None in node and (best is None or node[None] < best):
+				best = node[None]
+
+			if depth == len(text) or not text[depth] in node:
+				break
+
+			node = node[text[depth]]
+
+		return best
+
+class CandidateAutomaton:
+	# Aho-Corasick automaton over candidate strings. Each state remembers the
+	# earliest position of any candidate ending there, including those reached
+	# through failure links, so that lookups keep first-match order.
+	def __init__(self, candidates):
+		noMatch = len(candidates)
+
+		self.goto = [ {} ]
+		self.best = [ noMatch ]
+		for (i, candidate) in enumerate(candidates):
+			state = 0
+			for c in candidate:
+				if not c in self.goto[state]:
+					self.goto.append({})
+					self.best.append(noMatch)
+					self.goto[state][c] = len(self.goto) - 1
+				state = self.goto[state][c]
+
+			self.best[state] = min(self.best[state], i)
+
+		# Breadth first so that a state's failure target is finished before it
+		self.fail = [ 0 ] * len(self.goto)
+		queue = collections.deque(self.goto[0].values())
+		while len(queue) > 0:
+			state = queue.popleft()
+			for (c, child) in self.goto[state].items():
+				fallback = self.fail[state]
+				while fallback != 0 and not c in self.goto[fallback]:
+					fallback = self.fail[fallback]
+
+				if c in self.goto[fallback] and self.goto[fallback][c] != child:
+					self.fail[child] = self.goto[fallback][c]
+
+				self.best[child] = min(self.best[child], self.best[self.fail[child]])
+				queue.append(child)
+
+		self.noMatch = noMatch
+
+	def firstMatch(self, text):
+		# Position of the earliest candidate occurring anywhere in text, or None.
+		state = 0
+		best = self.best[0]
+		for c in text:
+			while state != 0 and not c in self.goto[state]:
+				state = self.fail[state]
+
+			state = self.goto[state].get(c, 0)
+			best = min(best, self.best[state])
+
+		if best == self.noMatch:
+			return None
+
+		return best
+
 class WordPartUnigramTrait(UnigramTrait):
 	def __init__(self):
 		self.accepted = None
+		self.candidates = None
+		self.indexedCandidates = None
+		self.index = None
+
+	def getCachedCandidates(self):
+		if self.candidates is None:
+			self.candidates = self.getCandidates()
+
+		return self.candidates
+
+	def getIndex(self, candidates):
+		# Only rebuilt when handed a different list, e.g. once selfSelect or
+		# setAcceptedByTrait replaces the candidates with the accepted ones.
+		if not candidates is self.indexedCandidates:
+			self.index = self.buildIndex(candidates)
+			self.indexedCandidates = candidates
+
+		return self.index
+
+	def buildIndex(self, candidates):
+		return None
 
 	def calcJointFreq(self, taggedSentences, tags, candidates):
-		candidates = self.getCandidates()
+		return self.calcJointFreqFromCounts(countTagsByWord(taggedSentences), tags, candidates)
+
+	def calcJointFreqFromCounts(self, tagCountsByWord, tags, candidates):
+		# Each distinct word is tested once and weighted by its counts
+		candidates = self.getCachedCandidates()
 		D = { d : { s : 0 for s in candidates } for d in tags }
 
-		for taggedSentence in taggedSentences:
-			for taggedWord in taggedSentence.taggedWords:
-				tag = taggedWord.tag
-				word = taggedWord.word
-				satisfied, match = self.satisfies(candidates, word)
-				if satisfied:
-					D[tag][match] += 1
+		for (word, tagCounts) in tagCountsByWord.items():
+			satisfied, match = self.satisfies(candidates, word)
+			if satisfied:
+				for (tag, count) in tagCounts.items():
+					D[tag][match] += count
 
 		return D
 
 	def selfSelect(self, taggedSentences, tags):
+		self.selfSelectFromCounts(countTagsByWord(taggedSentences), tags)
+
+	def selfSelectFromCounts(self, tagCountsByWord, tags):
 		if not self.accepted is None:
 			return
 
-		candidates = self.getCandidates()
-		D = self.calcJointFreq(taggedSentences, tags, candidates)
+		candidates = self.getCachedCandidates()
+		D = self.calcJointFreqFromCounts(tagCountsByWord, tags, candidates)
 		E = jointFreqMatrix.toProbColGivenRow(D, tags, candidates)
 
 		accepted = []
@@ -186,7 +303,7 @@ class WordPartUnigramTrait(UnigramTrait):
 	def isAMatch(self, word):
 		candidates = self.accepted
 		if candidates is None:
-			candidates = self.getCandidates()
+			candidates = self.getCachedCandidates()
 
 		return self.satisfies(candidates, word)
 
@@ -198,25 +315,36 @@ class InSetUnigramTrait(WordPartUnigramTrait):
 		return (word.lower() in candidates, word.lower())
 
 class InfixUnigramTrait(WordPartUnigramTrait):
+	def buildIndex(self, candidates):
+		return CandidateAutomaton([ infix.lower() for infix in candidates ])
+
 	def satisfies(self, candidates, word):
-		for infix in candidates:
-			if infix.lower() in word.lower():
-				return (True, infix)
-		return (False, None)
+		i = self.getIndex(candidates).firstMatch(word.lower())
+		if i is None:
+			return (False, None)
+		return (True, candidates[i])
 
 class PrefixUnigramTrait(WordPartUnigramTrait):
+	def buildIndex(self, candidates):
+		return CandidateTrie(candidates)
+
 	def satisfies(self, candidates, word):
-		for prefix in candidates:
-			if len(prefix) < len(word) and word.lower().startswith(prefix):
-				return (True, prefix)
-		return (False, None)
+		# Only prefixes strictly shorter than the word
+		i = self.getIndex(candidates).firstMatch(word.lower(), len(word) - 1)
+		if i is None:
+			return (False, None)
+		return (True, candidates[i])
 
 class SuffixUnigramTrait(WordPartUnigramTrait):
+	def buildIndex(self, candidates):
+		return CandidateTrie([ suffix[::-1] for suffix in candidates ])
+
 	def satisfies(self, candidates, word):
-		for suffix in candidates:
-			if len(suffix) < len(word) and word.lower().endswith(suffix):
-				return (True, suffix)
-		return (False, None)
+		# Only suffixes strictly shorter than the word
+		i = self.getIndex(candidates).firstMatch(word.lower()[::-1], len(word) - 1)
+		if i is None:
+			return (False, None)
+		return (True, candidates[i])
 
 class EnglishSuffixUnigramTrait(SuffixUnigramTrait):
 	def getCandidates(self):
@@ -311,18 +439,43 @@ class ChemicalFormulaUnigramTrait(RegExUnigramTrait):
 	def __init__(self):
 		symbols = ["Ac", "Al", "Am", "Sb", "Ar", "As", "At", "Ba", "Bk", "Be", "Bi", "Bh", "B", "Br", "Cd", "Ca", "Cf", "C", "Ce", "Cs", "Cl", "Cr", "Co", "Cu", "Cm", "Ds", "Db", "Dy", "Es", "Er", "Eu", "Fm", "F", "Fr", "Gd", "Ga", "Ge", "Au", "Hf", "Hs", "He", "Ho", "H", "In", "I", "Ir", "Fe", "Kr", "La", "Lr", "Pb", "Li", "Lu", "Mg", "Mn", "Mt", "Md", "Hg", "Mo", "Nd", "Ne", "Np", "Ni", "Nb", "N", "No", "Os", "O", "Pd", "P", "Pt", "Pu", "Po", "K", "Pr", "Pm", "Pa", "Ra", "Rn", "Re", "Rh", "Rg", "Rb", "Ru", "Rf", "Sm", "Sc", "Sg", "Se", "Si", "Ag", "Na", "Sr", "S", "Ta", "Tc", "Te", "Tb", "Tl", "Th", "Tm", "Sn", "Ti", "W", "Uub", "Uuh", "Uuo", "Uup", "Uuq", "Uus", "Uut", "Uuu", "U", "V", "Xe", "Yb", "Y", "Zn", "Zr"]
 
-		symbols = "|".join(symbols)
-		expr = "^((%s)\d*)+$" % (symbols)
-		self.regex = re.compile(expr)
+		self.symbols = set(symbols)
+		self.maxSymbolLength = max(map(len, symbols))
 
 	def getName(self):
 		return "ChemicalFormula"
 
 	def getRegEx(self):
-		return self.regex
+		# "^((symbol)\d*)+$" backtracks exponentially on long tokens, so
+		# isAMatch parses formulas itself.
+		return None
 
-#	def isAMatch(self, word):
-#		todo, need CFG parser to do this robustly.
+	def isAMatch(self, word):
+		if word is None:
+			return False, None
+
+		return self.isFormula(word), word
+
+	def isFormula(self, word):
+		# One or more element symbols, each followed by optional digits.
+		# reachable[i] means word[:i] parses, each position is visited once.
+		n = len(word)
+		reachable = [ False ] * (n + 1)
+		reachable[0] = True
+		for i in xrange(0, n):
+			if not reachable[i]:
+				continue
+
+			for length in xrange(1, min(self.maxSymbolLength, n - i) + 1):
+				if word[i:i + length] in self.symbols:
+					# A symbol never starts with a digit, so all the digits
+					# that follow are consumed.
+					j = i + length
+					while j < n and word[j] in string.digits:
+						j += 1
+					reachable[j] = True
+
+		return n > 0 and reachable[n]
 
 class OTricharsUnigramTrait(InfixUnigramTrait):
 	def getCandidates(self):
@@ -352,3 +505,111 @@ unigramTraitList = [
 	EnglishSuffixUnigramTrait(), LatinPrefixUnigramTrait(), LatinSuffixUnigramTrait(),
 	AllLowerLettersUnigramTrait() # to least specific match
 ]
+
+def countTagsByWord(taggedSentences):
+	# { word : Counter { tag : count } } over every token in the corpus
+	tagCountsByWord = collections.defaultdict(collections.Counter)
+
+	if isinstance(taggedSentences, common.TaggedCorpus):
+		# Count (word id, tag id) pairs without materializing any tokens
+		numTags = len(taggedSentences.tagNames)
+		pairs = taggedSentences.wordIds.astype(numpy.int64) * numTags + taggedSentences.tagIds
+		uniquePairs, counts = numpy.unique(pairs, return_counts = True)
+		for (pair, count) in zip(uniquePairs, counts):
+			word = taggedSentences.vocabulary[pair // numTags]
+			tagCountsByWord[word][taggedSentences.tagNames[pair % numTags]] += int(count)
+
+		return tagCountsByWord
+
+	for taggedSentence in taggedSentences:
+		for taggedWord in taggedSentence.taggedWords:
+			tagCountsByWord[taggedWord.word][taggedWord.tag] += 1
+
+	return tagCountsByWord
+
+def selfSelectAll(unigramTraits, taggedSentences, tags):
+	# One pass over the corpus shared by every trait
+	tagCountsByWord = countTagsByWord(taggedSentences)
+	for unigramTrait in unigramTraits:
+		unigramTrait.selfSelectFromCounts(tagCountsByWord, tags)
+
+def getAcceptedByTrait(unigramTraits):
+	# The state chosen by WordPartUnigramTrait.selfSelect, keyed by trait name
+	return { unigramTrait.getName() : unigramTrait.accepted for unigramTrait in unigramTraits
+		if isinstance(unigramTrait, WordPartUnigramTrait) and not unigramTrait.accepted is None }
+
+def setAcceptedByTrait(unigramTraits, acceptedByTrait):
+	for unigramTrait in unigramTraits:
+		if unigramTrait.getName() in acceptedByTrait:
+			unigramTrait.accepted = acceptedByTrait[unigramTrait.getName()]
+
+class RegExUnigramTraitClassifier:
+	# Tests a word against several RegExUnigramTraits with one combined
+	# pattern. Alternatives are tried in list order, so classify returns the
+	# first of the traits that matches, or None.
+	def __init__(self, regExTraits):
+		self.regExTraits = regExTraits
+		self.regex = None
+		if len(regExTraits) > 0:
+			self.regex = re.compile("|".join([
+				"(?P<t%d>%s)" % (i, regExTrait.getRegEx().pattern) for (i, regExTrait) in enumerate(regExTraits)
+			]))
+
+	def classify(self, word):
+		if self.regex is None:
+			return None
+
+		match = self.regex.match(word)
+		if match is None:
+			return None
+
+		return self.regExTraits[int(match.lastgroup[1:])]
+
+class UnigramTraitResolver:
+	# Resolves a word to the rewriteWord of the first trait in unigramTraits
+	# that matches it, or None. Build it after selfSelect, since the results
+	# are memoized per raw word.
+	def __init__(self, unigramTraits, maxCacheSize = 100000):
+		self.unigramTraits = unigramTraits
+		self.maxCacheSize = maxCacheSize
+		self.cache = {}
+
+		# Regular expression traits are all tested with one scan up front
+		regExTraits = [ unigramTrait for unigramTrait in unigramTraits
+			if isinstance(unigramTrait, RegExUnigramTrait) and not unigramTrait.getRegEx() is None ]
+		self.regExClassifier = RegExUnigramTraitClassifier(regExTraits)
+		self.isRegExTrait = [ unigramTrait in regExTraits for unigramTrait in unigramTraits ]
+
+	def resolve(self, word):
+		if word in self.cache:
+			return self.cache[word]
+
+		regExTrait = self.regExClassifier.classify(word)
+
+		newWord = None
+		for (unigramTrait, isRegExTrait) in zip(self.unigramTraits, self.isRegExTrait):
+			if isRegExTrait:
+				if unigramTrait is regExTrait:
+					newWord = unigramTrait.rewriteWord(word)
+					break
+				continue
+
+			hasMatch, match = unigramTrait.isAMatch(word)
+			if hasMatch:
+				newWord = unigramTrait.rewriteWord(match)
+				break
+
+		# Word frequencies are Zipfian, so starting over once the cache is full
+		# quickly recovers the frequent words while bounding memory.
+		if len(self.cache) >= self.maxCacheSize:
+			self.cache.clear()
+		self.cache[word] = newWord
+
+		return newWord
+
+	def rewriteWord(self, word, default):
+		newWord = self.resolve(word)
+		if newWord is None:
+			return default
+
+		return newWord
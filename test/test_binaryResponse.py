@@ -1,5 +1,9 @@
+import random
 import unittest
 
+import numpy
+import scipy.sparse
+
 from src import binaryResponse
 
 class LogisticRegressionTest(unittest.TestCase):
@@ -33,5 +37,45 @@ class LogisticRegressionTest(unittest.TestCase):
 		self.assertAlmostEqual(p["1"], 0.53, 2)
 		self.assertAlmostEqual(p["0"], 0.47, 2)
 
+class SparseLogisticRegressionTest(unittest.TestCase):
+	def setUp(self):
+		# Words 0-9 mostly label "1", words 10-19 mostly label "0"
+		rand = random.Random(0)
+		rows = []
+		self.labels = []
+		for i in xrange(0, 2000):
+			words = [ rand.randint(0, 19) for _ in xrange(0, 3) ]
+			rows.append(words)
+			isOne = sum([ word < 10 for word in words ]) >= 2
+			self.labels.append("1" if isOne != (rand.random() < 0.05) else "0")
+
+		self.X = scipy.sparse.csr_matrix((
+			numpy.ones(3 * len(rows)),
+			[ word for words in rows for word in words ],
+			numpy.arange(0, 3 * len(rows) + 1, 3)
+		), shape = (len(rows), 20))
+
+	def test_fit(self):
+		model = binaryResponse.SparseLogisticRegression(maxEpochs = 100).fit(self.X, self.labels)
+
+		self.assertEqual(model.labels, [ "0", "1" ])
+		self.assertTrue(all(model.weights[:10] > 0))
+		self.assertTrue(all(model.weights[10:] < 0))
+
+		# Early stopping ends well before maxEpochs
+		self.assertTrue(len(model.losses) < 100)
+
+		accuracy = numpy.mean([ e == a for (e, a) in zip(self.labels, model.predict(self.X)) ])
+		self.assertTrue(accuracy > 0.9)
+
+	def test_predictProba(self):
+		model = binaryResponse.SparseLogisticRegression(maxEpochs = 5, validationFraction = 0).fit(self.X, self.labels)
+
+		batched = model.predictProba(self.X[:50])
+		self.assertEqual(batched.shape, (50, 2))
+		self.assertTrue(numpy.allclose(batched.sum(axis = 1), 1.0))
+		for i in xrange(0, 50):
+			self.assertTrue(numpy.allclose(model.predictProba(self.X[i].toarray()), batched[i]))
+
 if __name__ == "__main__":
 	unittest.main()
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from src import common
 
@@ -43,6 +45,48 @@ class TestCommonTaggedSentence(unittest.TestCase):
 
 		self.assertEqual(actual, tags)
 
+class TestCommonTaggedCorpus(unittest.TestCase):
+	def setUp(self):
+		self.taggedSentences = [
+			common.TaggedSentence( [ common.TaggedWord(word, tag) for (word, tag) in zip(words.split(), tags) ] )
+			for (words, tags) in [ ("the quick brown fox.", "OBIO"), ("a fox", "OI"), ("", "") ]
+		]
+
+	def test_views(self):
+		corpus = common.TaggedCorpus(self.taggedSentences)
+
+		self.assertEqual(len(corpus), 3)
+		for (expected, actual) in zip(self.taggedSentences, corpus):
+			self.assertEqual(actual.taggedWords, expected.taggedWords)
+			self.assertEqual(actual.toWordSeq(), expected.toWordSeq())
+			self.assertEqual(actual.toTagSeq(), expected.toTagSeq())
+			self.assertEqual(repr(actual), repr(expected))
+
+		self.assertEqual(corpus[-2].taggedWords[1].word, "fox")
+		self.assertEqual(sorted(corpus.vocabulary), sorted(set("the quick brown fox. a fox".split())))
+
+	def test_slice(self):
+		corpus = common.TaggedCorpus(self.taggedSentences)
+
+		sliced = corpus[1:]
+		self.assertEqual(len(sliced), 2)
+		self.assertEqual(sliced[0].toWordSeq(), [ "a", "fox" ])
+		self.assertEqual(sliced[0].toTagSeq(), list("OI"))
+		self.assertEqual(sliced[1].toWordSeq(), [])
+		self.assertEqual(len(corpus[2:1]), 0)
+
+		# Slices only carry the words they use
+		self.assertEqual(sorted(sliced.vocabulary), [ "a", "fox" ])
+		self.assertEqual(corpus[2:1].vocabulary, [])
+
+	def test_mapWords(self):
+		corpus = common.TaggedCorpus(self.taggedSentences).mapWords(lambda word: word[0])
+
+		self.assertEqual(corpus[0].toWordSeq(), [ "t", "q", "b", "f" ])
+		self.assertEqual(corpus[1].toWordSeq(), [ "a", "f" ])
+		self.assertEqual(corpus[0].toTagSeq(), list("OBIO"))
+		self.assertEqual(sorted(corpus.vocabulary), [ "a", "b", "f", "q", "t" ])
+
 class TestCommonLabeledFormat(unittest.TestCase):
 	def test_getGenes(self):
 		words = "the quick brown fox.".split()
@@ -58,5 +102,112 @@ class TestCommonLabeledFormat(unittest.TestCase):
 
 		self.assertEqual(actual, expected)
 
+	def test_deserializeColumns(self):
+		fd, filePath = tempfile.mkstemp()
+		os.write(fd, "O\tthe\nB\tquick\n\n\n\nI\tfox\n\nO\ta\nO\tlongsentence\nI\tfox")
+		os.close(fd)
+
+		try:
+			lFormat = common.LabeledFormat()
+			for chunkSize in [ 1, 8, 1 << 24 ]:
+				actual = list(lFormat.deserializeColumns(filePath, chunkSize))
+				self.assertEqual(sum([ words for (words, _, _) in actual ], []), [ "the", "quick", "fox", "a", "longsentence", "fox" ])
+				self.assertEqual(sum([ tags for (_, tags, _) in actual ], []), list("OBIOOI"))
+				self.assertEqual(sum([ lengths for (_, _, lengths) in actual ], []), [ 2, 1, 3 ])
+
+			taggedSentences = list(lFormat.deserialize(filePath))
+			self.assertEqual([ s.toWordSeq() for s in taggedSentences ], [ [ "the", "quick" ], [ "fox" ], [ "a", "longsentence", "fox" ] ])
+
+			corpus = lFormat.deserializeCorpus(filePath)
+			self.assertEqual(len(corpus), 3)
+			self.assertEqual(corpus[2].toTagSeq(), list("OOI"))
+		finally:
+			os.remove(filePath)
+
+	def test_deserializeStripsWords(self):
+		fd, filePath = tempfile.mkstemp()
+		os.write(fd, "O\tthe \r\nB\tquick\r\n\nI\t fox\n")
+		os.close(fd)
+
+		try:
+			lFormat = common.LabeledFormat()
+			expected = [ [ "the", "quick" ], [ "fox" ] ]
+
+			words = sum([ words for (words, _, _) in lFormat.deserializeColumns(filePath) ], [])
+			self.assertEqual(words, sum(expected, []))
+			self.assertEqual([ s.toWordSeq() for s in lFormat.deserialize(filePath) ], expected)
+			self.assertEqual([ s.toWordSeq() for s in lFormat.deserializeCorpus(filePath) ], expected)
+		finally:
+			os.remove(filePath)
+
+	def test_cache(self):
+		fd, filePath = tempfile.mkstemp()
+		os.close(fd)
+
+		taggedSentences = [
+			common.TaggedSentence( [ common.TaggedWord(word, tag) for (word, tag) in zip(words.split(), tags) ] )
+			for (words, tags) in [ ("the quick brown fox.", "OBIO"), ("", ""), ("a fox", "OI") ]
+		]
+		cacheFormat = common.CorpusCacheFormat()
+
+		try:
+			lFormat = common.LabeledFormat()
+			lFormat.serialize(taggedSentences, filePath)
+			self.assertFalse(cacheFormat.isFresh(filePath))
+
+			# The text reader skips the empty sentence and so must the cache
+			expected = [ s.taggedWords for s in lFormat.deserialize(filePath) ]
+			self.assertEqual(expected, [ s.taggedWords for s in taggedSentences if len(s.taggedWords) > 0 ])
+
+			# A whole second so that utime can restore it exactly below
+			mtime = 1000000000
+			os.utime(filePath, (mtime, mtime))
+			lFormat.serializeCache(taggedSentences, filePath)
+			self.assertTrue(cacheFormat.isFresh(filePath))
+
+			# Served from the cache while the text keeps its size and mtime
+			size = os.path.getsize(filePath)
+			with open(filePath, 'wb') as f:
+				f.write("\n" * size)
+			os.utime(filePath, (mtime, mtime))
+			self.assertTrue(cacheFormat.isFresh(filePath))
+
+			corpus = lFormat.deserializeCorpus(filePath)
+			self.assertEqual([ s.taggedWords for s in corpus ], expected)
+			self.assertEqual([ s.taggedWords for s in lFormat.deserialize(filePath) ], expected)
+
+			# Sections start on 8 byte boundaries
+			self.assertEqual(cacheFormat.header.size % 8, 0)
+			self.assertTrue(corpus.offsets.flags.aligned)
+			self.assertTrue(corpus.wordIds.flags.aligned)
+
+			# Stale after a rewrite within the same mtime tick
+			with open(filePath, 'wb') as f:
+				f.write("O\tfox\n")
+			os.utime(filePath, (mtime, mtime))
+			self.assertFalse(cacheFormat.isFresh(filePath))
+			self.assertEqual([ s.toWordSeq() for s in lFormat.deserializeCorpus(filePath) ], [ [ "fox" ] ])
+
+			uFormat = common.UnlabeledFormat()
+			uFormat.serializeCache([ common.Sentence(s.toWordSeq()) for s in taggedSentences ], filePath)
+			self.assertEqual([ s.words for s in uFormat.deserialize(filePath) ], [ [ w.word for w in words ] for words in expected ])
+		finally:
+			os.remove(filePath)
+			if os.path.exists(cacheFormat.getCachePath(filePath)):
+				os.remove(cacheFormat.getCachePath(filePath))
+
+class TestCommonUnlabeledFormat(unittest.TestCase):
+	def test_deserialize(self):
+		fd, filePath = tempfile.mkstemp()
+		os.write(fd, "the\nquick\n\nfox\n")
+		os.close(fd)
+
+		try:
+			uFormat = common.UnlabeledFormat()
+			actual = [ sentence.words for sentence in uFormat.deserialize(filePath) ]
+			self.assertEqual(actual, [ [ "the", "quick" ], [ "fox" ] ])
+		finally:
+			os.remove(filePath)
+
 if __name__ == "__main__":
 	unittest.main() 
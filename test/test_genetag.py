@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+from src import genetag
+
+class TestGenetagTagFormat(unittest.TestCase):
+	def setUp(self):
+		fd, self.filePath = tempfile.mkstemp()
+		os.write(fd, "\n".join([
+			"@@1", "The_TAG IL-2_GENE1 gene_GENE1 ,_TAG binds_TAG ._TAG",
+			"@@2", "",
+			"@@3", "NF_kappa_GENE2 B_GENE2 (_TAG p50_GENE1 )_TAG",
+			"", "",
+			"@@4", "Never_TAG read_TAG",
+		]))
+		os.close(fd)
+
+		self.expected = [
+			[ ("The", "O"), ("IL-2", "I"), ("gene", "I"), ("binds", "O") ],
+			[],
+			[ ("NF_kappa", "I"), ("B", "I"), ("p50", "I") ],
+		]
+
+	def tearDown(self):
+		os.remove(self.filePath)
+
+	def toPairs(self, taggedSentences):
+		return [ [ (taggedWord.word, taggedWord.tag) for taggedWord in taggedSentence.taggedWords ] for taggedSentence in taggedSentences ]
+
+	def test_deserialize(self):
+		tagFormat = genetag.TagFormat()
+		self.assertEqual(self.toPairs(tagFormat.deserialize(self.filePath)), self.expected)
+
+	def test_iterDeserialize(self):
+		tagFormat = genetag.TagFormat()
+		for blockSize in [ 1, 20, 1 << 22 ]:
+			for workers in [ 1, 2 ]:
+				actual = tagFormat.iterDeserialize(self.filePath, workers, blockSize)
+				self.assertEqual(self.toPairs(actual), self.expected)
+
+if __name__ == "__main__":
+	unittest.main()
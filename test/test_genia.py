@@ -0,0 +1,34 @@
+import os
+import tempfile
+import unittest
+from src import genia
+
+class TestGeniaXmlFormat(unittest.TestCase):
+	def test_iterDeserialize(self):
+		fd, filePath = tempfile.mkstemp()
+		os.write(fd, """<?xml version="1.0" encoding="UTF-8"?>
+<set>
+<article><articleinfo><bibliomisc>MEDLINE:1</bibliomisc></articleinfo>
+<title><sentence>Activation of <cons lex="IL-2_gene" sem="G#DNA">the <cons lex="IL-2">IL-2</cons> gene</cons>.</sentence></title>
+<abstract>
+<sentence><cons lex="NF-kappa_B">NF-&#954;B</cons> binds &amp; is <cons lex="T_cell">T cells</cons></sentence>
+<sentence></sentence>
+<sentence>No genes here (at all).</sentence>
+</abstract>
+</article>
+</set>""")
+		os.close(fd)
+
+		try:
+			xmlFormat = genia.XmlFormat()
+			expected = xmlFormat.deserializeDom(filePath)
+			actual = list(xmlFormat.iterDeserialize(filePath))
+
+			self.assertEqual(len(actual), 4)
+			self.assertEqual([ s.taggedWords for s in actual ], [ s.taggedWords for s in expected ])
+			self.assertEqual([ s.taggedWords for s in xmlFormat.deserialize(filePath) ], [ s.taggedWords for s in expected ])
+		finally:
+			os.remove(filePath)
+
+if __name__ == "__main__":
+	unittest.main()
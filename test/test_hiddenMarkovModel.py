@@ -1,8 +1,41 @@
+import itertools
+import math
+import random
+import shutil
+import tempfile
 import unittest
 
+import numpy
+
 from src import common
 from src import hiddenMarkovModel as hmm
 
+def randomTaggedSentences(rand, vocab, tags, count, maxLength):
+	# count sentences of 1 to maxLength words, each word and tag drawn at random
+	return [
+		common.TaggedSentence( [
+			common.TaggedWord(rand.choice(vocab), rand.choice(tags)) for _ in xrange(0, rand.randint(1, maxLength))
+		] ) for _ in xrange(0, count)
+	]
+
+def sentenceEmissions(decoder, sentence):
+	# T x N emission log-probabilities of a single sentence
+	return decoder.emissionScores(numpy.array([ decoder.logSpace.toWordIds(sentence.words) ]))[0]
+
+def bigramPathScore(logSpace, emissions, path):
+	# Log joint probability of the words and a tag path under a first-order model
+	return logSpace.logInitVec[path[0]] + emissions[0, path[0]] + sum([ logSpace.logStateTrans[path[t - 1], path[t]] + emissions[t, path[t]] for t in xrange(1, len(path)) ])
+
+def trigramPathScore(trigramStats, emissions, path):
+	# As bigramPathScore under a second-order model, N pads the start
+	N = len(trigramStats.tags)
+	padded = [ N, N ] + list(path)
+	return sum([ trigramStats.logTrigramTrans[padded[t], padded[t + 1], padded[t + 2]] + emissions[t, path[t]] for t in xrange(0, len(path)) ])
+
+def scoreEveryPath(score, N, T):
+	# Brute force, (path, score(path)) for each of the N ** T tag paths
+	return [ (path, score(path)) for path in itertools.product(range(0, N), repeat = T) ]
+
 class TestHmmHistogram(unittest.TestCase):
 	def test_toDistribution(self):
 		H = hmm.Histogram()
@@ -81,6 +114,100 @@ class TestHmmCorpusStatistics(unittest.TestCase):
 
 		self.assertEqual(corpusStats.wordGivenTag, expectedWordGivenTag)
 
+	def assertSameStatistics(self, actual, expected):
+		self.assertEqual(actual.initVec, expected.initVec)
+		self.assertEqual(actual.stateTrans, expected.stateTrans)
+		self.assertEqual(actual.wordGivenTag, expected.wordGivenTag)
+		self.assertEqual(sorted(actual.States), sorted(expected.States))
+
+	def test_updateMergeRetract(self):
+		taggedSentences = randomTaggedSentences(random.Random(0), "abcdef", "BIO", 40, 8)
+		first, second = taggedSentences[:25], taggedSentences[25:]
+
+		expected = hmm.CorpusStatistics(taggedSentences)
+
+		updated = hmm.CorpusStatistics(first)
+		updated.initVec
+		updated.update(second)
+		self.assertSameStatistics(updated, expected)
+
+		merged = hmm.CorpusStatistics(first)
+		merged.merge(hmm.CorpusStatistics(second))
+		self.assertSameStatistics(merged, expected)
+
+		expected.retract(second)
+		self.assertSameStatistics(expected, hmm.CorpusStatistics(first))
+
+		unseen = common.TaggedSentence([ common.TaggedWord("z", "X") ])
+		self.assertRaises(ValueError, expected.retract, [ unseen ])
+		self.assertSameStatistics(expected, hmm.CorpusStatistics(first))
+
+	def test_buildFromShards(self):
+		taggedSentences = randomTaggedSentences(random.Random(1), "abcdef", "BIO", 40, 8)
+		expected = hmm.CorpusStatistics(taggedSentences)
+
+		corpus = common.TaggedCorpus(taggedSentences)
+		self.assertSameStatistics(hmm.CorpusStatistics(corpus), expected)
+
+		shards = [ corpus[i:i + 7] for i in xrange(0, len(corpus), 7) ]
+		for workers in [ 1, 2 ]:
+			actual = hmm.buildCorpusStatistics(shards, workers = workers)
+			self.assertEqual(actual.transFreq.keys(), expected.transFreq.keys())
+			for tag in expected.transFreq:
+				self.assertEqual(actual.transFreq[tag].freq, expected.transFreq[tag].freq)
+			self.assertSameStatistics(actual, expected)
+
+class TestHmmLogSpaceStatistics(unittest.TestCase):
+	def test_emissionTable(self):
+		words = "the quick brown fox.".split()
+		tags = ["O", "B", "I", "O"]
+		taggedSentence = common.TaggedSentence( [
+			common.TaggedWord(word, tag) for (word, tag) in zip(words, tags)
+			] )
+
+		logSpace = hmm.CorpusStatistics([ taggedSentence ]).toLogSpace()
+
+		self.assertEqual(sorted(logSpace.vocabulary), sorted(words))
+		self.assertEqual(list(logSpace.toWordIds(["fox.", "unseen"])), [ logSpace.vocabulary["fox."], len(words) ])
+
+		O = logSpace.tags.index("O")
+		B = logSpace.tags.index("B")
+		self.assertEqual(logSpace.logWordGivenTag[logSpace.vocabulary["the"], O], math.log(0.5))
+		self.assertEqual(logSpace.logWordGivenTag[logSpace.vocabulary["the"], B], float("-inf"))
+
+class TestHmmModelFormat(unittest.TestCase):
+	def setUp(self):
+		self.dirPath = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dirPath)
+
+	def test_roundTrip(self):
+		words = "the quick brown fox.".split()
+		tags = ["O", "B", "I", "O"]
+		taggedSentence = common.TaggedSentence( [
+			common.TaggedWord(word, tag) for (word, tag) in zip(words, tags)
+			] )
+
+		logSpace = hmm.CorpusStatistics([ taggedSentence ]).toLogSpace()
+		acceptedByTrait = { "LatinSuffix" : [ "us", "a" ], "GreekLetter" : [] }
+
+		modelFormat = hmm.ModelFormat()
+		modelFormat.serialize(logSpace, acceptedByTrait, self.dirPath)
+		loaded, loadedAcceptedByTrait = modelFormat.deserialize(self.dirPath)
+
+		self.assertEqual(loaded.tags, logSpace.tags)
+		self.assertEqual(loaded.vocabulary, logSpace.vocabulary)
+		self.assertEqual(loadedAcceptedByTrait, acceptedByTrait)
+		for name in [ "logInitVec", "logStateTrans", "logWordGivenTag" ]:
+			self.assertTrue(numpy.array_equal(getattr(loaded, name), getattr(logSpace, name)))
+
+		sentence = common.Sentence("the brown fox. jumped".split())
+		self.assertEqual(
+			hmm.TagDecoder(loaded).decode(sentence).taggedWords,
+			hmm.TagDecoder(logSpace).decode(sentence).taggedWords
+			)
+
 class TestHmmTagDecoder(unittest.TestCase):
 	def test_decode(self):
 		iceCreamModel = hmm.CorpusStatistics([])
@@ -101,5 +228,205 @@ class TestHmmTagDecoder(unittest.TestCase):
 		tagged = decoder.decode(common.Sentence(["3", "1", "3"]))
 		self.assertEqual(tagged.toTagSeq(), ["HOT", "HOT", "HOT"])
 
+	def test_decodeMatchesScalar(self):
+		rand = random.Random(0)
+		vocab = [ "w%d" % i for i in xrange(0, 50) ]
+		tags = [ "B", "I", "O" ]
+
+		train = randomTaggedSentences(rand, vocab, tags, 200, 20)
+		corpusStats = hmm.CorpusStatistics(train)
+
+		scalar = hmm.ScalarTagDecoder(corpusStats)
+		vectorized = hmm.TagDecoder(corpusStats)
+
+		# Include words that were never observed to exercise unknownWordProb
+		vocab += [ "unseen%d" % i for i in xrange(0, 10) ]
+		for n in xrange(0, 30):
+			sentence = common.Sentence([ rand.choice(vocab) for _ in xrange(0, n) ])
+			self.assertEqual(
+				vectorized.decode(sentence).taggedWords,
+				scalar.decode(sentence).taggedWords
+				)
+
+	def test_decodeBatch(self):
+		rand = random.Random(1)
+		vocab = [ "w%d" % i for i in xrange(0, 50) ]
+		tags = [ "I", "O" ]
+
+		train = randomTaggedSentences(rand, vocab, tags, 100, 20)
+		corpusStats = hmm.CorpusStatistics(train)
+		scalar = hmm.ScalarTagDecoder(corpusStats)
+		decoder = hmm.TagDecoder(corpusStats)
+
+		sentences = [ common.Sentence([ rand.choice(vocab) for _ in xrange(0, n % 7) ]) for n in xrange(0, 40) ]
+		expected = [ scalar.decode(sentence).taggedWords for sentence in sentences ]
+
+		# A small batch size splits each length bucket across several batches
+		actual = [ tagged.taggedWords for tagged in decoder.decodeBatch(sentences, batchSize = 2) ]
+
+		self.assertEqual(actual, expected)
+
+class TestHmmForwardBackward(unittest.TestCase):
+	def setUp(self):
+		rand = random.Random(4)
+		self.vocab = [ "w%d" % i for i in xrange(0, 20) ]
+		tags = [ "B", "I", "O" ]
+
+		train = randomTaggedSentences(rand, self.vocab, tags, 100, 10)
+		self.decoder = hmm.TagDecoder(hmm.CorpusStatistics(train))
+		self.rand = rand
+
+	def test_posteriorBatch(self):
+		logSpace = self.decoder.logSpace
+		N = len(logSpace.tags)
+
+		sentences = [ common.Sentence([ self.rand.choice(self.vocab + [ "unseen" ]) for _ in xrange(0, n % 5) ]) for n in xrange(0, 15) ]
+		for (sentence, (marginals, logLikelihood)) in zip(sentences, self.decoder.posteriorBatch(sentences, batchSize = 2)):
+			T = len(sentence.words)
+			self.assertEqual(marginals.shape, (T, N))
+			if T == 0:
+				continue
+
+			emissions = sentenceEmissions(self.decoder, sentence)
+			expected = numpy.zeros((T, N))
+			total = 0.0
+			for (path, score) in scoreEveryPath(lambda path: bigramPathScore(logSpace, emissions, path), N, T):
+				p = math.exp(score)
+				total += p
+				for t in xrange(0, T):
+					expected[t, path[t]] += p
+
+			self.assertAlmostEqual(logLikelihood, math.log(total))
+			self.assertTrue(numpy.allclose(marginals, expected / total))
+
+	def test_longSentence(self):
+		sentence = common.Sentence([ self.rand.choice(self.vocab) for _ in xrange(0, 2000) ])
+		marginals, logLikelihood = self.decoder.posterior(sentence)
+
+		self.assertTrue(numpy.isfinite(logLikelihood))
+		self.assertTrue(numpy.allclose(marginals.sum(axis = 1), 1.0))
+
+class TestHmmNBest(unittest.TestCase):
+	def test_decodeNBestBatch(self):
+		rand = random.Random(5)
+		vocab = [ "w%d" % i for i in xrange(0, 20) ]
+		tags = [ "B", "I", "O" ]
+
+		train = randomTaggedSentences(rand, vocab, tags, 100, 10)
+		decoder = hmm.TagDecoder(hmm.CorpusStatistics(train))
+		logSpace = decoder.logSpace
+		N = len(logSpace.tags)
+
+		sentences = [ common.Sentence([ rand.choice(vocab + [ "unseen" ]) for _ in xrange(0, n % 5) ]) for n in xrange(0, 15) ]
+		nBest = decoder.decodeNBestBatch(sentences, k = 5, batchSize = 2)
+
+		# The first of each list is the Viterbi path
+		expected = [ tagged.taggedWords for tagged in decoder.decodeBatch(sentences) ]
+		self.assertEqual([ candidates[0][0].taggedWords for candidates in nBest ], expected)
+		self.assertEqual([ candidates[0][0].taggedWords for candidates in decoder.decodeNBestBatch(sentences, k = 1) ], expected)
+
+		for (sentence, candidates) in zip(sentences, nBest):
+			T = len(sentence.words)
+			if T == 0:
+				self.assertEqual(len(candidates), 1)
+				continue
+
+			emissions = sentenceEmissions(decoder, sentence)
+			def score(path):
+				return bigramPathScore(logSpace, emissions, path)
+
+			best = sorted([ pathScore for (_, pathScore) in scoreEveryPath(score, N, T) ], reverse = True)[:5]
+
+			self.assertEqual(len(candidates), len(best))
+			for ((tagged, actual), expectedScore) in zip(candidates, best):
+				self.assertAlmostEqual(actual, expectedScore)
+				self.assertAlmostEqual(score([ logSpace.tags.index(tag) for tag in tagged.toTagSeq() ]), actual)
+			self.assertEqual(len(set([ tuple(tagged.toTagSeq()) for (tagged, _) in candidates ])), len(candidates))
+
+	def test_k(self):
+		decoder = hmm.TagDecoder(hmm.CorpusStatistics([ common.TaggedSentence([ common.TaggedWord("a", "O") ]) ]))
+		sentence = common.Sentence([ "a" ])
+
+		self.assertRaises(ValueError, decoder.decodeNBest, sentence, k = 0)
+		self.assertRaises(ValueError, decoder.decodeNBestBatch, [ common.Sentence([]) ], k = 0)
+		self.assertRaises(ValueError, decoder.nBestViterbi, numpy.zeros((1, 1), dtype=int), 0)
+		self.assertEqual(len(decoder.decodeNBest(sentence, k = 1)), 1)
+
+class TestHmmBeamTagDecoder(unittest.TestCase):
+	def test_decodeBatch(self):
+		rand = random.Random(3)
+		vocab = [ "w%d" % i for i in xrange(0, 30) ]
+		tags = [ "T%d" % i for i in xrange(0, 8) ]
+
+		train = randomTaggedSentences(rand, vocab, tags, 200, 12)
+		corpusStats = hmm.CorpusStatistics(train)
+		sentences = [ common.Sentence([ rand.choice(vocab) for _ in xrange(0, n % 9) ]) for n in xrange(0, 40) ]
+
+		exact = hmm.TagDecoder(corpusStats)
+		expected = [ tagged.taggedWords for tagged in exact.decodeBatch(sentences) ]
+
+		# A beam as wide as the tag set is exact Viterbi
+		wide = hmm.BeamTagDecoder(corpusStats, beamWidth = len(tags))
+		self.assertEqual([ tagged.taggedWords for tagged in wide.decodeBatch(sentences) ], expected)
+
+		# A greedy beam still tags every word
+		for decoder in [ hmm.BeamTagDecoder(corpusStats, beamWidth = 1), hmm.BeamTagDecoder(corpusStats, beamWidth = 3, beamThreshold = 2.0) ]:
+			for (sentence, tagged) in zip(sentences, decoder.decodeBatch(sentences)):
+				self.assertEqual(tagged.toWordSeq(), sentence.words)
+				self.assertTrue(all([ tag in tags for tag in tagged.toTagSeq() ]))
+
+	def test_beamWidth(self):
+		corpusStats = hmm.CorpusStatistics([ common.TaggedSentence([ common.TaggedWord("a", "O") ]) ])
+		self.assertRaises(ValueError, hmm.BeamTagDecoder, corpusStats, beamWidth = 0)
+
+class TestHmmTrigramTagDecoder(unittest.TestCase):
+	def setUp(self):
+		rand = random.Random(2)
+		self.vocab = [ "w%d" % i for i in xrange(0, 20) ]
+		tags = [ "B", "I", "O" ]
+
+		self.train = randomTaggedSentences(rand, self.vocab, tags, 200, 10)
+		self.rand = rand
+
+	def test_statistics(self):
+		trigramStats = hmm.TrigramStatistics(self.train)
+
+		self.assertAlmostEqual(sum(trigramStats.lambdas), 1.0)
+		probs = numpy.exp(trigramStats.logTrigramTrans)
+		self.assertTrue(numpy.allclose(probs.sum(axis = 2)[len(trigramStats.tags)], 1.0))
+
+		fromCorpus = hmm.TrigramStatistics(common.TaggedCorpus(self.train))
+		self.assertEqual(fromCorpus.lambdas, trigramStats.lambdas)
+		self.assertTrue(numpy.array_equal(fromCorpus.logTrigramTrans, trigramStats.logTrigramTrans))
+
+	def test_withoutSmoothing(self):
+		# I never starts a sentence, so it is missing from States
+		train = [ common.TaggedSentence([ common.TaggedWord(word, tag) for (word, tag) in zip("the IL-2 gene".split(), "OIO") ]) ]
+
+		for corpus in [ train, common.TaggedCorpus(train) ]:
+			trigramStats = hmm.TrigramStatistics(corpus, useSmoothing = False)
+			self.assertEqual(sorted(trigramStats.tags), [ "I", "O" ])
+			self.assertEqual(trigramStats.lambdas, hmm.TrigramStatistics(train, useSmoothing = False).lambdas)
+
+			tagged = hmm.TrigramTagDecoder(trigramStats).decode(common.Sentence("the IL-2 gene".split()))
+			self.assertEqual(tagged.toTagSeq(), list("OIO"))
+
+	def test_decodeIsBestPath(self):
+		trigramStats = hmm.TrigramStatistics(self.train)
+		decoder = hmm.TrigramTagDecoder(trigramStats)
+		N = len(trigramStats.tags)
+
+		sentences = [ common.Sentence([ self.rand.choice(self.vocab + [ "unseen" ]) for _ in xrange(0, n % 5 + 1) ]) for n in xrange(0, 20) ]
+		for (sentence, tagged) in zip(sentences, decoder.decodeBatch(sentences, batchSize = 3)):
+			emissions = sentenceEmissions(decoder, sentence)
+			def score(path):
+				return trigramPathScore(trigramStats, emissions, path)
+
+			best = max([ pathScore for (_, pathScore) in scoreEveryPath(score, N, len(sentence.words)) ])
+			path = [ trigramStats.tags.index(tag) for tag in tagged.toTagSeq() ]
+
+			self.assertEqual(tagged.toWordSeq(), sentence.words)
+			self.assertAlmostEqual(score(path), best)
+
 if __name__ == "__main__":
 	unittest.main() 
@@ -0,0 +1,105 @@
+import unittest
+
+import numpy
+
+from src import common
+from src import main
+
+def taggedSentences():
+	return [
+		common.TaggedSentence( [ common.TaggedWord(word, tag) for (word, tag) in zip(words.split(), tags) ] )
+		for (words, tags) in [
+			("the IL-2 gene binds p50 .", "OIIOIO"),
+			("human NF-kappa B activates the kinase", "OIIIOI"),
+			("a mouse protein of 42 residues", "OOIOOO"),
+			("the alpha subunit and the beta subunit", "OIIOOII"),
+		]
+	]
+
+class TestMainFeaturizer(unittest.TestCase):
+	def setUp(self):
+		self.featurizer = main.Featurizer(taggedSentences())
+		self.width = len(self.featurizer.kinds)
+
+	def test_layout(self):
+		words = "the kinase binds".split()
+		features = self.featurizer.featurizeSentence(common.Sentence(words))
+
+		self.assertEqual(features.shape, (3, 20))
+		self.assertEqual(len(self.featurizer.window) * len(self.featurizer.kinds), 20)
+
+		# Offset 0 is the middle block, kinds varying fastest
+		center = self.featurizer.window.index(0) * self.width
+		for (t, word) in enumerate(words):
+			self.assertEqual(tuple(features[t, center:center + self.width]), self.featurizer.wordFeatureIds(word))
+
+	def test_offsets(self):
+		words = "human NF-kappa B activates the kinase".split()
+		features = self.featurizer.featurizeSentence(common.Sentence(words))
+
+		for t in xrange(0, len(words)):
+			for (i, offset) in enumerate(self.featurizer.window):
+				actual = tuple(features[t, i * self.width:(i + 1) * self.width])
+				if 0 <= t + offset < len(words):
+					self.assertEqual(actual, self.featurizer.wordFeatureIds(words[t + offset]))
+				else:
+					# Positions outside the sentence are padded with id 0
+					self.assertEqual(actual, (0,) * self.width)
+
+	def test_padding(self):
+		features = self.featurizer.featurizeSentence(common.Sentence([ "gene" ]))
+
+		self.assertEqual(features.shape, (1, 20))
+		self.assertTrue(numpy.all(features[0, :2 * self.width] == 0))
+		self.assertTrue(numpy.all(features[0, 3 * self.width:] == 0))
+		self.assertTrue(numpy.all(features[0, 2 * self.width:3 * self.width] > 0))
+
+	def test_emptySentence(self):
+		self.assertEqual(self.featurizer.featurizeSentence(common.Sentence([])).shape, (0, 20))
+
+		features, tags = self.featurizer.featurizeTaggedSentence(common.TaggedSentence([]))
+		self.assertEqual(features.shape, (0, 20))
+		self.assertEqual(tags, [])
+
+	def test_repeatedWords(self):
+		first = self.featurizer.featurizeSentence(common.Sentence("the gene the gene".split()))
+		sizes = [ len(idTable) for idTable in self.featurizer.idTables ]
+
+		# Known words reuse their cached ids and add nothing to the tables
+		second = self.featurizer.featurizeSentence(common.Sentence("gene the".split()))
+		self.assertEqual([ len(idTable) for idTable in self.featurizer.idTables ], sizes)
+		self.assertTrue(numpy.array_equal(first[0, 8:12], second[1, 8:12]))
+		self.assertTrue(numpy.array_equal(first[0, 8:12], first[2, 8:12]))
+		self.assertTrue(self.featurizer.wordFeatureIds("the") is self.featurizer.wordFeatureIds("the"))
+
+class TestMainTagPredictor(unittest.TestCase):
+	def setUp(self):
+		self.train = taggedSentences()
+		self.featurizer = main.Featurizer(self.train)
+
+	def test_hashedMatchesVocabulary(self):
+		counted = main.TagPredictor(self.train, self.featurizer)
+		hashed = main.TagPredictor(self.train, self.featurizer, hashed = True)
+
+		words = [ word for sentence in self.train for word in sentence.toWordSeq() ] + [ "IL-4", "rat", "of", "unseen" ]
+		self.assertEqual(hashed.predictValues(words), counted.predictValues(words))
+
+	def test_predictSentences(self):
+		predictor = main.TagPredictor(self.train, self.featurizer, hashed = True)
+		sentences = [
+			common.Sentence("the IL-2 gene".split()),
+			common.Sentence([]),
+			common.Sentence([ "kinase" ]),
+			common.Sentence([]),
+		]
+
+		tagged = predictor.predictSentences(sentences)
+		self.assertEqual([ t.toWordSeq() for t in tagged ], [ s.words for s in sentences ])
+		self.assertEqual(sum([ t.toTagSeq() for t in tagged ], []), predictor.predictValues([ "the", "IL-2", "gene", "kinase" ]))
+
+		self.assertEqual(predictor.predictValues([]), [])
+		self.assertEqual(predictor.predictSentences([]), [])
+		self.assertEqual([ t.taggedWords for t in predictor.predictSentences([ common.Sentence([]) ]) ], [ [] ])
+
+if __name__ == "__main__":
+	unittest.main()
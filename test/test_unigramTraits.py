@@ -1,5 +1,8 @@
+import random
+import re
 import unittest
 
+from src import common
 from src import unigramTraits
 
 class PositiveNegativeUnigramTraitTest:
@@ -189,5 +192,135 @@ class ChemicalFormulaUnigramTraitTest(unittest.TestCase, PositiveNegativeUnigram
 	def getNegativeExamples(self):
 		return [ "", "c", "The" ]
 
+class ChemicalFormulaParseTest(unittest.TestCase):
+	def test_sameAsRegEx(self):
+		trait = unigramTraits.ChemicalFormulaUnigramTrait()
+		symbols = "|".join(sorted(trait.symbols))
+		regex = re.compile("^((%s)\d*)+$" % symbols)
+
+		rand = random.Random(0)
+		parts = [ "C", "H", "O", "N", "Na", "Cl", "Uub", "U", "u", "b", "c", "2", "10", "x" ]
+		for _ in xrange(0, 2000):
+			word = "".join([ rand.choice(parts) for _ in xrange(0, rand.randint(0, 6)) ])
+			self.assertEqual(trait.isFormula(word), not regex.match(word) is None)
+
+	def test_longToken(self):
+		# Would backtrack for a very long time with the nested quantifier
+		trait = unigramTraits.ChemicalFormulaUnigramTrait()
+		self.assertFalse(trait.isFormula("CO" * 5000 + "x"))
+		self.assertTrue(trait.isFormula("CO2" * 5000))
+
+	def test_noneWord(self):
+		hasMatch, match = unigramTraits.ChemicalFormulaUnigramTrait().isAMatch(None)
+		self.assertFalse(hasMatch)
+		self.assertTrue(match is None)
+
+class RegExUnigramTraitClassifierTest(unittest.TestCase):
+	def test_classify(self):
+		traits = [ trait for trait in unigramTraits.unigramTraitList
+			if isinstance(trait, unigramTraits.RegExUnigramTrait) and not trait.getRegEx() is None ]
+		classifier = unigramTraits.RegExUnigramTraitClassifier(traits)
+
+		words = [ "", "(", "..", "IV", "42", "1,234", "+3.5", "DNA", "Kinase", "kinase", "C3PO", "a-b" ]
+		for word in words:
+			expected = None
+			for trait in traits:
+				hasMatch, match = trait.isAMatch(word)
+				if hasMatch:
+					expected = trait
+					break
+
+			self.assertTrue(classifier.classify(word) is expected)
+
+class WordPartIndexTest(unittest.TestCase):
+	# Linear scans that the indexed satisfies() must agree with
+	def linearInfix(self, candidates, word):
+		for infix in candidates:
+			if infix.lower() in word.lower():
+				return (True, infix)
+		return (False, None)
+
+	def linearPrefix(self, candidates, word):
+		for prefix in candidates:
+			if len(prefix) < len(word) and word.lower().startswith(prefix):
+				return (True, prefix)
+		return (False, None)
+
+	def linearSuffix(self, candidates, word):
+		for suffix in candidates:
+			if len(suffix) < len(word) and word.lower().endswith(suffix):
+				return (True, suffix)
+		return (False, None)
+
+	def assertSameAsLinear(self, trait, linear):
+		rand = random.Random(0)
+		letters = "abcAB"
+		candidates = [ "".join([ rand.choice(letters) for _ in xrange(0, rand.randint(0, 4)) ]) for _ in xrange(0, 30) ]
+		words = [ "".join([ rand.choice(letters) for _ in xrange(0, rand.randint(0, 8)) ]) for _ in xrange(0, 500) ]
+
+		for word in words:
+			self.assertEqual(trait.satisfies(candidates, word), linear(candidates, word))
+
+	def test_infix(self):
+		self.assertSameAsLinear(unigramTraits.ITricharsUnigramTrait(), self.linearInfix)
+
+	def test_prefix(self):
+		self.assertSameAsLinear(unigramTraits.LatinPrefixUnigramTrait(), self.linearPrefix)
+
+	def test_suffix(self):
+		self.assertSameAsLinear(unigramTraits.EnglishSuffixUnigramTrait(), self.linearSuffix)
+
+class SelfSelectTest(unittest.TestCase):
+	def test_selfSelectAll(self):
+		words = "the kinase binds running receptors and the phosphatase binds its receptor".split()
+		tags = [ "O", "I", "O", "O", "I", "O", "O", "I", "O", "O", "I" ]
+		taggedSentences = [ common.TaggedSentence( [
+			common.TaggedWord(word, tag) for (word, tag) in zip(words, tags)
+		] ) ] * 3
+
+		separately = [ unigramTraits.EnglishSuffixUnigramTrait(), unigramTraits.LatinPrefixUnigramTrait() ]
+		for trait in separately:
+			trait.selfSelect(taggedSentences, [ "I", "O" ])
+
+		together = [ unigramTraits.EnglishSuffixUnigramTrait(), unigramTraits.LatinPrefixUnigramTrait() ]
+		unigramTraits.selfSelectAll(together, taggedSentences, [ "I", "O" ])
+
+		for (a, b) in zip(separately, together):
+			self.assertEqual(sorted(a.accepted), sorted(b.accepted))
+
+		counts = unigramTraits.countTagsByWord(taggedSentences)
+		self.assertEqual(counts["the"], { "O" : 6 })
+		self.assertEqual(counts["binds"], { "O" : 6 })
+
+class UnigramTraitResolverTest(unittest.TestCase):
+	def test_resolve(self):
+		traits = [ unigramTraits.PuncUnigramTrait(), unigramTraits.GreekLetterUnigramTrait(), unigramTraits.AllLowerLettersUnigramTrait() ]
+		resolver = unigramTraits.UnigramTraitResolver(traits, maxCacheSize = 2)
+
+		words = [ "(", "mu", "mu", "kinase", "IL-2", "(", "." ]
+		expected = [ "PuncOpen", "GreekLetter", "GreekLetter", "AllLowerLetters", None, "PuncOpen", "PuncSepEnd" ]
+
+		self.assertEqual([ resolver.resolve(word) for word in words ], expected)
+		self.assertTrue(len(resolver.cache) <= 2)
+
+		self.assertEqual(resolver.rewriteWord("IL-2", "XXX"), "XXX")
+		self.assertEqual(resolver.rewriteWord("mu", "XXX"), "GreekLetter")
+
+	def test_sameAsTraitOrder(self):
+		traits = unigramTraits.unigramTraitList
+		resolver = unigramTraits.UnigramTraitResolver(traits)
+
+		words = [ "(", "NF", "human", "kinase", "alpha", "NaCl", "gene", "XIV", "mu", "IL2", "42", "4.2",
+			"DNA", "The", "and", "these", "of", "pretending", "running", "abnormal", "carbonas", "lorem", "X-ray" ]
+		for word in words:
+			expected = None
+			for trait in traits:
+				hasMatch, match = trait.isAMatch(word)
+				if hasMatch:
+					expected = trait.rewriteWord(match)
+					break
+
+			self.assertEqual(resolver.resolve(word), expected)
+
 if __name__ == "__main__":
 	unittest.main()